@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2024 Avnet
+"""
+JSON Backend Benchmark
+
+Times the JSON work the /IOTCONNECT Plug and Play application does every cycle
+(parsing the data buffer and producer records, serializing forwarded commands
+and batches) with each installed backend. Run it on the target board to decide
+whether installing orjson or ujson is worth it:
+
+    python3 benchmarks/json_backends.py
+"""
+
+import json
+import timeit
+
+# Representative payloads: a typical data buffer, a sensor record as sent to
+# the data socket or a ring, and a forwarded command
+DATA_BUFFER = json.dumps({
+    "random_number": 42,
+    "random_color": "purple",
+    "temperature": 23.71,
+    "humidity": 48.2,
+    "pressure": 1013.25,
+    "accel": {"x": 0.012, "y": -0.981, "z": 0.044},
+    "status": "running",
+    "uptime": 86400,
+    "firmware": "1.4.2",
+    "alarms": [False, False, True, False],
+}).encode()
+RECORD = json.dumps({"current": 1.234, "voltage": 229.8, "rpm": 1480}).encode()
+BATCH = [json.loads(RECORD) for _ in range(50)]
+COMMAND = {"command_name": "set-led", "parameters": " red 50", "timestamp": 1729238400}
+
+ITERATIONS = 20000
+
+
+def backends():
+    yield "json (indent=4)", json.loads, lambda obj: json.dumps(obj, indent=4)
+    yield "json", json.loads, lambda obj: json.dumps(obj, separators=(",", ":"))
+    try:
+        import ujson
+        yield "ujson", ujson.loads, ujson.dumps
+    except ImportError:
+        print("ujson not installed, skipping")
+    try:
+        import orjson
+        yield "orjson", orjson.loads, lambda obj: orjson.dumps(obj).decode()
+    except ImportError:
+        print("orjson not installed, skipping")
+
+
+def measure(function):
+    # Best of 5 runs, in microseconds per call
+    return min(timeit.repeat(function, number=ITERATIONS, repeat=5)) / ITERATIONS * 1e6
+
+
+def main():
+    print(f"{'backend':<16}{'buffer load':>14}{'record load':>14}{'command dump':>14}{'batch dump':>14}   (us per call)")
+    baseline = None
+    for name, loads, dumps in backends():
+        timings = (
+            measure(lambda: loads(DATA_BUFFER)),
+            measure(lambda: loads(RECORD)),
+            measure(lambda: dumps(COMMAND)),
+            measure(lambda: dumps(BATCH)),
+        )
+        if baseline is None:
+            baseline = timings
+        speedups = "  ".join(f"{base / timing:4.1f}x" for base, timing in zip(baseline, timings))
+        print(f"{name:<16}" + "".join(f"{timing:14.2f}" for timing in timings) + f"   {speedups}")
+
+
+if __name__ == "__main__":
+    main()
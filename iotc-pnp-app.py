@@ -13,18 +13,152 @@ import os
 import urllib.request
 import json
 import fcntl
+import hashlib
+import asyncio
+import socket
+import struct
+import ctypes
+import ctypes.util
+import mmap
+import collections
+import math
+import re
+import ast
+import operator
+import fnmatch
+import heapq
+import sqlite3
+import multiprocessing
+import concurrent.futures
+import signal
 import requests
+from datetime import datetime, timezone
+
+# Optional, only needed for AGGREGATE_ATTRIBUTES and WAVEFORM_ATTRIBUTES
+try:
+    import numpy
+except ImportError:
+    numpy = None
 from avnet.iotconnect.sdk.lite import Client, DeviceConfig, C2dCommand, Callbacks, DeviceConfigError
 from avnet.iotconnect.sdk.lite import __version__ as SDK_VERSION
-from avnet.iotconnect.sdk.sdklib.mqtt import C2dAck, C2dOta
+from avnet.iotconnect.sdk.sdklib.mqtt import C2dAck, C2dOta, TelemetryRecord
 
 # ============================================================================
 # Constants
 # ============================================================================
 
 DATA_FREQUENCY = 5  # Seconds between telemetry transmissions
+JSON_BACKEND = "auto"  # JSON library for buffers and records: "auto" (orjson, else ujson, else json), "orjson", "ujson" or "json"
+STATS_INTERVAL = 300  # Seconds between printouts of the statistics counters (0 = never)
+MISSED_TICK_POLICY = "skip"  # After a stall (e.g. a slow reconnect): "skip" missed ticks and resume on schedule, or "burst" to run them back to back
+MAX_BURST_TICKS = 10  # Most missed ticks run back to back with the "burst" policy; older ones are skipped
+ALIGN_TO_WALL_CLOCK = False  # Tick on wall-clock multiples of DATA_FREQUENCY (e.g. :00, :05, :10) so samples from many boards line up
+DATA_BUFFER_WATCH = True  # Send as soon as a producer finishes writing the data buffer (Linux inotify, else polling)
+MIN_SEND_INTERVAL = 1  # Minimum seconds between telemetry transmissions when watching the data buffer
+SKIP_UNCHANGED_DATA = True  # Don't re-send the data buffer if no producer has changed it
+HEARTBEAT_INTERVAL = 60  # Seconds after which unchanged data is re-sent anyway so the device stays alive (0 = never)
+TRANSFORMS = {}  # Per-key plan turning raw producer values into attributes, e.g. {"reg_40001": {"rename": "temp", "scale": 0.1, "unit": "degF->degC"}, "gps": {"flatten": True}, "power": {"expression": "voltage * current"}}
+TEMPLATE_PATH = None  # Local copy of the device template JSON; when set, unknown attributes are dropped and values coerced to their types
+AGGREGATE_ATTRIBUTES = {}  # Numeric attributes sent as per-tick statistics instead of raw samples, e.g. {"temp": ["avg", "max"]} ([] for min/max/avg/stddev/count)
+AGGREGATE_WINDOW_SIZE = 4096  # Most recent samples per aggregated attribute that the statistics are computed over
+ALERT_RULES = []  # Rules sending an alert the moment they fire or clear, e.g. [{"name": "overheat", "when": "temp > 80 for 10s", "clear": "temp < 75", "command": "fan on"}]
+SKETCH_ATTRIBUTES = {}  # Numeric attributes sent as per-tick percentiles instead of raw samples, e.g. {"latency_ms": [50, 99]} ([] for SKETCH_PERCENTILES)
+SKETCH_PERCENTILES = [50, 95, 99]  # Default percentiles of sketched attributes, sent as <attribute>_p<percentile>
+SKETCH_RELATIVE_ACCURACY = 0.01  # Relative error of the sketched percentiles
+SKETCH_MAX_BINS = 2048  # Most buckets per sketch; the smallest values are merged beyond this
+SKETCH_STATE_PATH = "/home/weston/demo/sketch-state.json"  # Sketches saved here across the restart after an update
+WAVEFORM_ATTRIBUTES = {}  # Attributes whose value names a raw sample file (or "shm:<name>" in /dev/shm), sent as FFT features, e.g. {"vibration": {"dtype": "float32", "sample_rate": 25600, "bands": [[0, 1000], [1000, 5000]]}}
+WAVEFORM_WORKERS = 1  # Worker processes computing waveform features
+WAVEFORM_MAX_SAMPLES = 4194304  # Longest waveform read; a larger file is skipped so it can't exhaust a worker's memory
+DEADBANDS = {}  # Report-by-exception per attribute ("*" for all), e.g. {"temperature": {"absolute": 0.5}, "*": {"percent": 2, "max_silence": 60}}
+MAX_SILENCE = 300  # Seconds after which a deadbanded attribute is sent even if it didn't move
+DELTA_PAYLOADS = False  # Send only the attributes whose values changed since they were last sent
+DELTA_SNAPSHOT_EVERY = 12  # With delta payloads, a full snapshot of the latest data is sent after every N telemetry messages to resynchronize
+BATCH_MAX_RECORDS = 1  # Most records sent in one telemetry message (1 sends every record on its own)
+BATCH_MAX_BYTES = 16384  # Approximate JSON size at which a batch is sent
+BATCH_MAX_LATENCY = 5  # Seconds the oldest record may wait in a batch before it is sent
+OFFLINE_QUEUE_PATH = None  # SQLite file queueing telemetry while disconnected instead of exiting, e.g. "/home/weston/demo/offline-queue.db"
+OFFLINE_QUEUE_MAX_RECORDS = 100000  # Most records queued; the oldest are evicted beyond this
+OFFLINE_DRAIN_RATE = 10  # Queued messages sent per second once reconnected
+RECONNECT_INTERVAL = 30  # Seconds between reconnection attempts while queueing telemetry
+BATCH_PUBLISH_DUTY = 0.05  # Fraction of time publishing may take, timed until the broker acknowledges; slower links send bigger batches less often (0 = fixed limits)
+BATCH_MAX_STRETCH = 8  # Most a slow link multiplies the batch limits by; keep BATCH_MAX_BYTES times this under the broker's message size limit
+MTIME_GRANULARITY_NS = 2_000_000_000  # Coarsest file timestamp resolution expected (FAT SD cards use 2 seconds)
+BUFFER_LOCK_TIMEOUT = 0.1  # Seconds to wait for a producer's flock on the data buffer before retrying
+BUFFER_READ_RETRIES = 3  # Re-reads of a locked or half-written data buffer before falling back to the last good data
+BUFFER_RETRY_BACKOFF = 0.01  # Seconds before the first re-read, doubling with each retry
 COMMAND_BUFFER_PATH = "/home/weston/demo/command-buffer.json"
+COMMAND_WORKERS = 4  # Worker threads running commands that may block (file-download and in-process handlers)
+COMMAND_CONCURRENCY = {"file-download": 1}  # Most commands of one name handled at once, "*" for any other name (unlimited if absent)
+COMMAND_ROUTES = {}  # Command name or glob -> where to deliver it instead of the command buffer, e.g. {"led-*": {"file": "/home/weston/demo/led-command.json"}, "reboot": {"socket": "/run/iotc-pnp/reboot.sock"}, "ping": {"handler": "ping"}}
+COMMAND_SOCKET_PATH = None  # Unix socket pushing commands to the consumers subscribed to them the moment they arrive, e.g. "/run/iotc-pnp/command.sock"
+COMMAND_SOCKET_MAX_BACKLOG = 1048576  # Bytes of commands a subscriber hasn't read after which it is disconnected
+DEFERRED_ACKS = False  # Acknowledge forwarded commands with their consumer's result instead of as soon as they are forwarded
+COMMAND_RESULT_DIR = "/home/weston/demo/command-results"  # Consumers drop {"ack_id": ..., "success": ..., "message": ...} result files here (or send them on COMMAND_SOCKET_PATH)
+COMMAND_ACK_TIMEOUT = 30  # Seconds to wait for a consumer's result before acknowledging the command as failed
+COMMAND_LOG_DIR = None  # Append-only log of forwarded commands with sequence numbers, read by consumers at their own pace, e.g. "/home/weston/demo/command-log"
+COMMAND_LOG_SEGMENT_RECORDS = 1000  # Commands per command log segment file
+COMMAND_LOG_MAX_SEGMENTS = 10  # Most segments kept, even if a consumer hasn't read them yet
 DATA_BUFFER_PATH = "/home/weston/demo/data-buffer.json"
+DATA_BUFFER_FORMAT = "json"  # "json" (buffer holds the latest data) or "jsonl" (producers append one JSON record per line)
+DATA_BUFFER_OFFSET_PATH = "/home/weston/demo/data-buffer.offset"  # Saved read position in a "jsonl" buffer
+DATA_BUFFER_TIMESTAMP_KEY = "_ts"  # Optional key of a "jsonl" record holding its sample time (Unix seconds), removed before sending
+DATA_BUFFER_MAX_SIZE = 1048576  # Bytes after which a fully read "jsonl" buffer is truncated
+DATA_SPOOL_DIR = None  # Directory of per-producer *.json files used instead of DATA_BUFFER_PATH, e.g. "/run/iotc-pnp/data.d"
+SPOOL_CONFLICT_POLICY = "newest"  # Key written by several producers: "newest" file wins, "filename" (last in sort order) wins, or "prefix" keys with the file name
+DATA_SOCKET_PATH = None  # Unix socket accepting newline-delimited JSON telemetry records, e.g. "/run/iotc-pnp/data.sock"
+DATA_SOCKET_TYPE = "stream"  # "stream" (SOCK_STREAM connections) or "dgram" (SOCK_DGRAM, one or more records per datagram)
+DATA_SOCKET_MAX_RECORD = 65536  # Longest accepted record in bytes; a stream connection sending a longer line is closed, a longer datagram is dropped
+DATA_RING_DIR = None  # Directory of per-producer shared-memory ring buffers (*.ring) drained every cycle, e.g. "/dev/shm/iotc-pnp"
+
+# ============================================================================
+# JSON Backend
+# ============================================================================
+
+# Picks the JSON library used on the hot path (parsing the data buffer and
+# records, serializing commands and batches). orjson and ujson are optional
+# and several times faster than the standard library on small ARM cores.
+# All three raise a ValueError subclass on invalid JSON.
+def load_json_backend(name):
+    if name in ("auto", "orjson"):
+        try:
+            import orjson
+            return "orjson", orjson.loads, lambda obj: orjson.dumps(obj).decode()
+        except ImportError:
+            if name == "orjson":
+                raise
+    if name in ("auto", "ujson"):
+        try:
+            import ujson
+            return "ujson", ujson.loads, ujson.dumps
+        except ImportError:
+            if name == "ujson":
+                raise
+    return "json", json.loads, lambda obj: json.dumps(obj, separators=(",", ":"))
+
+
+json_backend, json_loads, json_dumps = load_json_backend(JSON_BACKEND)
+
+
+# ============================================================================
+# Statistics
+# ============================================================================
+
+# Counters for events worth keeping an eye on (rejected attributes, ring
+# overruns, ...), printed every STATS_INTERVAL seconds
+stats = collections.Counter()
+last_stats_report = time.monotonic()
+
+
+# Prints the counters if STATS_INTERVAL has passed since the last printout
+def report_stats():
+    global last_stats_report
+    if not STATS_INTERVAL or time.monotonic() - last_stats_report < STATS_INTERVAL:
+        return
+    last_stats_report = time.monotonic()
+    if stats:
+        print("Stats: " + ", ".join(f"{name}={count}" for name, count in sorted(stats.items())))
+
 
 # ============================================================================
 # JSON Buffer Management
@@ -41,10 +175,1788 @@ def cleanup_command_buffer():
         print(f"Error cleaning up command buffer: {e}")
 
 
+# Removes the data and command sockets (if exist) during shutdown so stale
+# socket files aren't left behind for producers and consumers to connect to
+def cleanup_sockets():
+    for path in (DATA_SOCKET_PATH, COMMAND_SOCKET_PATH):
+        try:
+            if path and os.path.exists(path):
+                os.remove(path)
+        except Exception as e:
+            print(f"Error cleaning up socket {path}: {e}")
+
+
+# Base for readers of a buffer that holds the latest data, which is sent as
+# one record whenever it changes
+class SnapshotReader:
+    # Returns the (timestamp, values) records to send this cycle
+    def read_records(self):
+        telemetry, changed = self.read()
+        if telemetry and (changed or not SKIP_UNCHANGED_DATA):
+            return [(datetime.now(timezone.utc), telemetry)]
+        return []
+
+    # Returns the latest data, re-sent as a heartbeat
+    def snapshot(self):
+        return self.telemetry
+
+    # Called once the records read are in the outbox; a snapshot has no read position to save
+    def commit(self):
+        pass
+
+
+# Reads the data buffer and reports whether its content changed. The stat
+# fingerprint (inode, size, mtime) is checked first so an untouched buffer is
+# never opened, and a content hash second so a rewrite of identical data is
+# never re-parsed or re-sent.
+#
+# Reads are safe against producers writing at the same time: the buffer is
+# read under a shared flock (producers that follow the guide hold LOCK_EX),
+# and from a single open file so a producer renaming a new file into place is
+# seen either entirely or not at all. A producer opening the buffer with "w"
+# truncates it before taking its lock, so an empty or half-written buffer is
+# re-read with a doubling backoff, and after BUFFER_READ_RETRIES the last good
+# data is used instead. Content that isn't a JSON object is treated as
+# invalid too. Waiting for the lock and backing off block, so the ingest task
+# calls the readers on a worker thread.
+class DataBufferReader(SnapshotReader):
+    def __init__(self, path):
+        self.path = path
+        self.fingerprint = None
+        self.fingerprint_trusted = False
+        self.digest = None
+        self.telemetry = None
+        self.missing = False
+
+    # Returns (telemetry, changed) where telemetry is the latest buffer content
+    def read(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            # Nothing to send until a producer creates the buffer
+            self.fingerprint = None
+            self.missing = True
+            return None, False
+        self.missing = False
+        if self.fingerprint_trusted and self.fingerprint == (st.st_ino, st.st_size, st.st_mtime_ns):
+            return self.telemetry, False
+
+        invalid_st = None
+        for attempt in range(BUFFER_READ_RETRIES + 1):
+            if attempt:
+                stats["buffer_read_retries"] += 1
+                time.sleep(BUFFER_RETRY_BACKOFF * 2 ** (attempt - 1))
+            try:
+                st, content = self.read_locked()
+            except FileNotFoundError:
+                self.fingerprint = None
+                self.missing = True
+                return None, False
+            except TimeoutError:
+                stats["buffer_lock_timeouts"] += 1
+                continue
+            if self.fingerprint is not None and st.st_ino != self.fingerprint[0]:
+                stats["buffer_replaced"] += 1
+
+            digest = hashlib.blake2b(content, digest_size=16).digest()
+            if digest != self.digest:
+                try:
+                    telemetry = json_loads(content)
+                except ValueError:
+                    telemetry = None
+                if not isinstance(telemetry, dict):
+                    stats["buffer_parse_errors"] += 1
+                    invalid_st = st
+                    continue
+                self.telemetry = telemetry
+                self.digest = digest
+                changed = True
+            else:
+                changed = False
+            self.remember_fingerprint(st)
+            return self.telemetry, changed
+
+        stats["buffer_last_good_used"] += 1
+        print(f"Unable to read complete data from {self.path}. Using the last good data.")
+        if invalid_st is not None:
+            # Don't re-read the same invalid content until the producer rewrites it
+            self.remember_fingerprint(invalid_st)
+        return self.telemetry, False
+
+    def snapshot(self):
+        return None if self.missing else self.telemetry
+
+    def remember_fingerprint(self, st):
+        self.fingerprint = (st.st_ino, st.st_size, st.st_mtime_ns)
+        # A write landing within the same mtime tick as this read would leave the
+        # fingerprint unchanged, so only trust fingerprints that are old enough
+        self.fingerprint_trusted = time.time_ns() - st.st_mtime_ns > MTIME_GRANULARITY_NS
+
+    # Returns the buffer's stat and content, read under a shared lock. Raises
+    # TimeoutError if a producer holds the lock for BUFFER_LOCK_TIMEOUT.
+    def read_locked(self):
+        with open(self.path, "rb") as f:
+            deadline = time.monotonic() + BUFFER_LOCK_TIMEOUT
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        raise TimeoutError
+                    time.sleep(0.005)
+            try:
+                return os.fstat(f.fileno()), f.read()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# Returns True for the producer files in the spool directory. Hidden files are
+# skipped so producers can write to e.g. ".sensor.json.tmp" and rename it into place.
+def is_spool_file(name):
+    return name.endswith(".json") and not name.startswith(".")
+
+
+# Reads every producer file in the spool directory and merges them into a
+# single telemetry dict. Each file keeps its own DataBufferReader, so only the
+# files that changed since the last call are re-read and re-parsed.
+class SpoolDirectoryReader(SnapshotReader):
+    def __init__(self, directory):
+        self.directory = directory
+        self.readers = {}
+        self.telemetry = {}
+
+    # Returns (telemetry, changed) where telemetry is the merged content of all producer files
+    def read(self):
+        try:
+            names = {entry.name for entry in os.scandir(self.directory) if is_spool_file(entry.name) and entry.is_file()}
+        except FileNotFoundError:
+            names = set()  # Removed since startup, so no producer has data
+        changed = names != self.readers.keys()
+        for name in self.readers.keys() - names:
+            del self.readers[name]
+
+        for name in names:
+            reader = self.readers.setdefault(name, DataBufferReader(os.path.join(self.directory, name)))
+            # An invalid file keeps this producer's previous data until it writes a valid one
+            _, file_changed = reader.read()
+            if reader.missing:
+                # Removed by its producer since the directory was listed
+                del self.readers[name]
+                changed = True
+                continue
+            changed = changed or file_changed
+
+        if changed:
+            self.telemetry = self.merge()
+        return self.telemetry, changed
+
+    # Merges the producer files according to SPOOL_CONFLICT_POLICY
+    def merge(self):
+        merged = {}
+        if SPOOL_CONFLICT_POLICY == "prefix":
+            for name, reader in self.readers.items():
+                prefix = name[:-len(".json")]
+                for key, value in (reader.telemetry or {}).items():
+                    merged[prefix + "_" + key] = value
+            return merged
+
+        if SPOOL_CONFLICT_POLICY == "newest":
+            # Fingerprint is (inode, size, mtime_ns), so this sorts oldest write first
+            ordered = sorted(self.readers.values(), key=lambda reader: (reader.fingerprint or (0, 0, 0))[2])
+        else:
+            ordered = [self.readers[name] for name in sorted(self.readers)]
+        for reader in ordered:
+            merged.update(reader.telemetry or {})
+        return merged
+
+
+# Tails a data buffer that producers append JSON records to, one per line, so
+# that no record is lost no matter how often they write. The read position is
+# saved to DATA_BUFFER_OFFSET_PATH by commit(), once the records read are in
+# the outbox (which is flushed before a restart), so a restart neither loses
+# nor repeats records. A truncated buffer is read again from the start, and a
+# buffer that was rotated (replaced by a new file) is read to its end before
+# switching. A record is timestamped with its DATA_BUFFER_TIMESTAMP_KEY if it
+# has one, else when it is read.
+class JsonLinesReader:
+    def __init__(self, path, offset_path):
+        self.path = path
+        self.offset_path = offset_path
+        self.file = None
+        self.inode = None
+        self.offset = 0
+        try:
+            with open(offset_path, "r") as f:
+                saved = json.load(f)
+            self.inode, self.offset = saved["inode"], saved["offset"]
+        except (OSError, ValueError, KeyError):
+            pass
+        self.saved_position = (self.inode, self.offset)
+
+    # Returns the (timestamp, values) records appended since the last call
+    def read_records(self):
+        records = []
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            st = None
+
+        if self.file is not None and (st is None or st.st_ino != self.inode):
+            # Rotated or removed: finish the old file, then start the new one
+            records += self.read_lines()
+            self.file.close()
+            self.file = None
+            self.inode, self.offset = None, 0
+        if st is None:
+            return records
+
+        if self.file is None:
+            self.file = open(self.path, "rb")
+            if st.st_ino != self.inode:
+                self.offset = 0
+            self.inode = os.fstat(self.file.fileno()).st_ino
+        if st.st_size < self.offset:
+            print(f"Data buffer {self.path} was truncated. Reading from the start.")
+            self.offset = 0
+
+        records += self.read_lines()
+        return records
+
+    # Saves the read position once the records read have been handed on, and
+    # compacts the buffer once it has grown past DATA_BUFFER_MAX_SIZE
+    def commit(self):
+        if self.file is not None and self.offset >= DATA_BUFFER_MAX_SIZE:
+            self.compact()
+        self.save_offset()
+
+    # Each record is a one-off sample, so there is no latest data to re-send
+    def snapshot(self):
+        return None
+
+    # Parses every complete line after the saved offset. A partially appended
+    # last line is left for the next call.
+    def read_lines(self):
+        self.file.seek(self.offset)
+        data = self.file.read()
+        end = data.rfind(b"\n") + 1
+        self.offset += end
+
+        records = []
+        read_time = datetime.now(timezone.utc)
+        for line in data[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                values = json_loads(line)
+            except ValueError as e:
+                print(f"Ignoring invalid record in data buffer: {e}")
+                continue
+            if not isinstance(values, dict):
+                continue
+            timestamp = read_time
+            sample_time = values.pop(DATA_BUFFER_TIMESTAMP_KEY, None)
+            if type(sample_time) is int or type(sample_time) is float:
+                timestamp = datetime.fromtimestamp(sample_time, timezone.utc)
+            records.append((timestamp, values))
+        return records
+
+    # Moves what hasn't been read yet to the start of the buffer, dropping
+    # everything before the read position. The exclusive lock keeps producers
+    # that append under LOCK_EX from writing meanwhile; if a producer holds it,
+    # compaction is tried again after the next read instead of waiting.
+    def compact(self):
+        with open(self.path, "r+b") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                stats["buffer_compactions_deferred"] += 1
+                return
+            try:
+                if os.fstat(f.fileno()).st_ino != self.inode:
+                    return  # Rotated meanwhile, picked up next cycle
+                f.seek(self.offset)
+                unread = f.read()
+                f.seek(0)
+                f.write(unread)
+                f.truncate(len(unread))
+                self.offset = 0
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def save_offset(self):
+        if (self.inode, self.offset) == self.saved_position:
+            return
+        temp_path = self.offset_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"inode": self.inode, "offset": self.offset}, f)
+        os.replace(temp_path, self.offset_path)
+        self.saved_position = (self.inode, self.offset)
+
+
+# Creates the reader for whichever data source is configured
+def create_data_reader():
+    if DATA_SPOOL_DIR:
+        # A directory under /run doesn't exist yet after boot
+        os.makedirs(DATA_SPOOL_DIR, exist_ok=True)
+        return SpoolDirectoryReader(DATA_SPOOL_DIR)
+    if DATA_BUFFER_FORMAT == "jsonl":
+        return JsonLinesReader(DATA_BUFFER_PATH, DATA_BUFFER_OFFSET_PATH)
+    return DataBufferReader(DATA_BUFFER_PATH)
+
+
+# ============================================================================
+# Socket Ingestion
+# ============================================================================
+
+# Local Unix socket that producers can send newline-delimited JSON records to
+# instead of writing the data buffer, skipping the filesystem entirely. Every
+# record is timestamped on arrival and sent as its own telemetry message.
+class SocketIngestServer:
+    def __init__(self, path, socket_type):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if os.path.exists(path):
+            os.remove(path)  # Stale socket from a previous run
+        self.path = path
+        self.stream = socket_type == "stream"
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM if self.stream else socket.SOCK_DGRAM)
+        self.server.bind(path)
+        if self.stream:
+            self.server.listen()
+        self.server.setblocking(False)
+        self.connections = {}  # Connected producer socket -> bytes of its unfinished line
+        self.records = []
+        self.loop = None
+        self.notify = None
+
+    # Services the sockets from the event loop, calling notify whenever new records arrive
+    def attach(self, loop, notify):
+        self.loop = loop
+        self.notify = notify
+        loop.add_reader(self.server, self.handle_readable, self.server)
+
+    def handle_readable(self, sock):
+        received = len(self.records)
+        if sock is self.server and self.stream:
+            try:
+                connection, _ = self.server.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            connection.setblocking(False)
+            self.connections[connection] = b""
+            self.loop.add_reader(connection, self.handle_readable, connection)
+        elif sock is self.server:
+            try:
+                # One byte more than accepted shows a datagram was truncated
+                datagram = self.server.recv(DATA_SOCKET_MAX_RECORD + 1)
+            except (BlockingIOError, InterruptedError):
+                return
+            if len(datagram) > DATA_SOCKET_MAX_RECORD:
+                stats["socket_datagrams_dropped"] += 1
+                return
+            for line in datagram.splitlines():
+                self.add_record(line)
+        else:
+            self.read_connection(sock)
+        if len(self.records) > received:
+            self.notify()
+
+    # Reads what a producer sent and parses every complete line
+    def read_connection(self, connection):
+        try:
+            data = connection.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.close_connection(connection)
+            return
+
+        *lines, partial = (self.connections[connection] + data).split(b"\n")
+        for line in lines:
+            self.add_record(line)
+        if len(partial) > DATA_SOCKET_MAX_RECORD:
+            print(f"Closing data socket connection that sent a record over {DATA_SOCKET_MAX_RECORD} bytes")
+            self.close_connection(connection)
+        else:
+            self.connections[connection] = partial
+
+    def add_record(self, line):
+        if not line.strip():
+            return
+        try:
+            values = json_loads(line)
+        except ValueError as e:
+            print(f"Ignoring invalid record on data socket: {e}")
+            return
+        if not isinstance(values, dict):
+            print("Ignoring data socket record that is not a JSON object")
+            return
+        self.records.append((datetime.now(timezone.utc), values))
+
+    def close_connection(self, connection):
+        del self.connections[connection]
+        self.loop.remove_reader(connection)
+        connection.close()
+
+    # Returns the (timestamp, values) records received since the last call
+    def take_records(self):
+        records, self.records = self.records, []
+        return records
+
+    def close(self):
+        for connection in list(self.connections):
+            self.close_connection(connection)
+        self.server.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# Creates the data socket server, or returns None if it is not configured
+def create_ingest_server():
+    if not DATA_SOCKET_PATH:
+        return None
+    server = SocketIngestServer(DATA_SOCKET_PATH, DATA_SOCKET_TYPE)
+    print(f"Accepting telemetry records on {DATA_SOCKET_PATH}")
+    return server
+
+
+# ============================================================================
+# Shared-Memory Ring Buffers
+# ============================================================================
+
+# Each producer owns one ring file and is its only writer, so no locking is
+# needed between producers. Layout:
+#   header: magic "IOTCRNG1", slot size, slot count, write sequence (padded to RING_HEADER_SIZE)
+#   slots:  sequence + 1 (0 while being written), producer time in ns, JSON length, JSON bytes
+# A producer writes record number seq into slot seq % slot_count by zeroing the
+# slot sequence, copying the JSON, setting the slot sequence to seq + 1 and
+# finally advancing the header write sequence.
+RING_MAGIC = b"IOTCRNG1"
+RING_HEADER = struct.Struct("<8sIIQ")
+RING_HEADER_SIZE = 64
+RING_WRITE_SEQ_OFFSET = 16
+RING_SEQ = struct.Struct("<Q")
+RING_SLOT_HEADER = struct.Struct("<QQI")
+
+
+# Drains one producer's ring, tracking the agent's own read sequence. Records
+# the producer overwrote before they were drained are counted as overruns.
+class SharedMemoryRing:
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(path, "rb") as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.slot_size, self.slot_count, write_seq = RING_HEADER.unpack_from(self.mm, 0)
+        if magic != RING_MAGIC or len(self.mm) < RING_HEADER_SIZE + self.slot_size * self.slot_count:
+            self.mm.close()
+            raise ValueError("not a ring buffer")
+        # Pick up whatever the producer wrote before the agent (re)started
+        self.read_seq = max(0, write_seq - self.slot_count)
+        self.overruns = 0
+
+    # Returns the (timestamp, values) records written since the last call
+    def drain(self):
+        write_seq = RING_SEQ.unpack_from(self.mm, RING_WRITE_SEQ_OFFSET)[0]
+        if write_seq < self.read_seq:
+            # Producer restarted and reinitialized the ring
+            self.read_seq = max(0, write_seq - self.slot_count)
+        if write_seq - self.read_seq > self.slot_count:
+            self.record_overrun(write_seq - self.read_seq - self.slot_count)
+            self.read_seq = write_seq - self.slot_count
+
+        records = []
+        for seq in range(self.read_seq, write_seq):
+            offset = RING_HEADER_SIZE + (seq % self.slot_count) * self.slot_size
+            slot_seq, time_ns, length = RING_SLOT_HEADER.unpack_from(self.mm, offset)
+            start = offset + RING_SLOT_HEADER.size
+            payload = self.mm[start:start + min(length, self.slot_size - RING_SLOT_HEADER.size)]
+            # The slot must still hold this record after the copy, otherwise the
+            # producer lapped the reader and the copy may be torn
+            if slot_seq != seq + 1 or RING_SEQ.unpack_from(self.mm, offset)[0] != slot_seq:
+                self.record_overrun(1)
+                continue
+            try:
+                values = json_loads(payload)
+            except ValueError as e:
+                print(f"Ignoring invalid record in ring {self.name}: {e}")
+                continue
+            if isinstance(values, dict):
+                records.append((datetime.fromtimestamp(time_ns / 1e9, timezone.utc), values))
+        self.read_seq = write_seq
+        return records
+
+    def record_overrun(self, lost):
+        self.overruns += lost
+        stats["ring_overruns"] += lost
+        print(f"Ring {self.name} overrun: {lost} records lost ({self.overruns} total)")
+
+    def close(self):
+        self.mm.close()
+
+
+# Drains every producer ring in the ring directory, opening rings as producers
+# create them and reopening them when a producer replaces its ring file
+class SharedMemoryRingReader:
+    def __init__(self, directory):
+        self.directory = directory
+        self.rings = {}
+
+    # Returns the (timestamp, values) records written to any ring since the last call
+    def drain(self):
+        records = []
+        entries = {entry.name: entry for entry in os.scandir(self.directory) if entry.name.endswith(".ring")}
+        for name in self.rings.keys() - entries.keys():
+            self.rings.pop(name).close()
+
+        for name, entry in entries.items():
+            ring = self.rings.get(name)
+            if ring is not None and ring.inode != entry.inode():
+                self.rings.pop(name).close()
+                ring = None
+            if ring is None:
+                try:
+                    ring = self.rings[name] = SharedMemoryRing(entry.path)
+                except (OSError, ValueError, struct.error):
+                    # Not initialized by its producer yet, try again next cycle
+                    continue
+            records += ring.drain()
+        return records
+
+
+# Creates the ring reader, or returns None if rings are not configured
+def create_ring_reader():
+    if not DATA_RING_DIR:
+        return None
+    os.makedirs(DATA_RING_DIR, exist_ok=True)
+    return SharedMemoryRingReader(DATA_RING_DIR)
+
+
+# ============================================================================
+# Data Buffer Watcher
+# ============================================================================
+
+IN_CLOSE_WRITE = 0x00000008  # File opened for writing was closed
+IN_MODIFY = 0x00000002  # File was written to
+IN_MOVED_TO = 0x00000080  # File was renamed into the watched directory
+INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len (followed by the file name)
+
+# Watches a directory with Linux inotify and reports which files in it a
+# producer finished writing (closed after writing or atomically renamed into place)
+class DirectoryWatcher:
+    def __init__(self, directory, mask=IN_CLOSE_WRITE | IN_MOVED_TO):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, "Unable to watch %s" % directory)
+
+    def fileno(self):
+        return self.fd
+
+    # Drains all pending events and returns the set of file names that changed
+    def read_changes(self):
+        names = set()
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                return names
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                names.add(os.fsdecode(data[offset:offset + length].rstrip(b"\0")))
+                offset += length
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Creates the watcher for the data buffer directory, or returns None if
+# watching is disabled or inotify is unavailable on this system
+def create_data_buffer_watcher():
+    if not DATA_BUFFER_WATCH:
+        return None
+    # Appenders may keep the buffer open, and only complete lines are read anyway
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO
+    if DATA_BUFFER_FORMAT == "jsonl" and not DATA_SPOOL_DIR:
+        mask |= IN_MODIFY
+    try:
+        return DirectoryWatcher(DATA_SPOOL_DIR or os.path.dirname(DATA_BUFFER_PATH) or ".", mask)
+    except (OSError, AttributeError) as e:
+        print(f"Unable to watch data buffer ({e}). Polling every {DATA_FREQUENCY} seconds instead.")
+        return None
+
+
+# Returns True if a changed file in the watched directory holds telemetry data
+def is_data_file(name):
+    if DATA_SPOOL_DIR:
+        return is_spool_file(name)
+    return name == os.path.basename(DATA_BUFFER_PATH)
+
+
+# Event loop reader for the watcher, setting data_ready when a data file changed
+def handle_watcher_readable(watcher, data_ready):
+    if any(is_data_file(name) for name in watcher.read_changes()):
+        data_ready.set()
+
+
+# Waits until the monotonic deadline, returning early (but not before
+# earliest) once data_ready is set by a data buffer write or socket record
+async def wait_for_data(data_ready, earliest, deadline):
+    try:
+        await asyncio.wait_for(data_ready.wait(), deadline - time.monotonic())
+    except asyncio.TimeoutError:
+        return
+    delay = min(earliest, deadline) - time.monotonic()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+# ============================================================================
+# Alert Rules
+# ============================================================================
+
+# A rule condition: "<attribute> <comparison> <number>", optionally followed
+# by "for <duration>" (ms, s or m) that it must hold for
+RULE_CONDITION = re.compile(r"\s*(\w+)\s*(>=|<=|==|!=|>|<)\s*(-?\d+(?:\.\d+)?)\s*(?:for\s+(\d+(?:\.\d+)?)\s*(ms|s|m)\s*)?$")
+RULE_COMPARISONS = {
+    ">": lambda limit: lambda value: value > limit,
+    ">=": lambda limit: lambda value: value >= limit,
+    "<": lambda limit: lambda value: value < limit,
+    "<=": lambda limit: lambda value: value <= limit,
+    "==": lambda limit: lambda value: value == limit,
+    "!=": lambda limit: lambda value: value != limit,
+}
+RULE_NEGATIONS = {">": "<=", ">=": "<", "<": ">=", "<=": ">", "==": "!=", "!=": "=="}
+RULE_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60}
+
+
+# Parses a rule condition into (attribute, comparison, limit, seconds)
+def parse_condition(expression):
+    match = RULE_CONDITION.match(expression)
+    if match is None:
+        raise ValueError(f"Invalid rule condition {expression!r}")
+    attribute, comparison, limit, duration, unit = match.groups()
+    return attribute, comparison, float(limit), float(duration) * RULE_DURATION_UNITS[unit] if duration else 0
+
+
+# An alert with hysteresis: it fires once its "when" condition has held for
+# the condition's duration, and only clears once its "clear" condition has
+# (by default the negated "when" condition). Conditions are compiled into
+# closures once, so evaluating a sample is a comparison and a few branches.
+class AlertRule:
+    def __init__(self, config):
+        self.name = config["name"]
+        self.attribute, comparison, limit, self.fire_after = parse_condition(config["when"])
+        self.fires = RULE_COMPARISONS[comparison](limit)
+        if "clear" in config:
+            attribute, comparison, limit, self.clear_after = parse_condition(config["clear"])
+            if attribute != self.attribute:
+                raise ValueError(f"Rule {self.name} clears on {attribute} but fires on {self.attribute}")
+        else:
+            comparison, self.clear_after = RULE_NEGATIONS[comparison], 0
+        self.clears = RULE_COMPARISONS[comparison](limit)
+        self.command = config.get("command", "").split()
+        self.active = False
+        self.since = None  # Time the condition to change state started holding
+        self.value = None  # Latest sample, which holds until the next one
+
+    # Returns True when the rule fires, False when it clears and None otherwise
+    def evaluate(self, value, now):
+        self.value = value
+        if not (self.clears(value) if self.active else self.fires(value)):
+            self.since = None
+            return None
+        if self.since is None:
+            self.since = now
+        if now - self.since < (self.clear_after if self.active else self.fire_after):
+            return None
+        self.active = not self.active
+        self.since = None
+        return self.active
+
+    # Returns the time the rule changes state if its latest value holds, or
+    # None if no change is pending
+    def due_time(self):
+        if self.since is None:
+            return None
+        return self.since + (self.clear_after if self.active else self.fire_after)
+
+
+# Evaluates the alert rules against every ingested sample, timing durations
+# by the records' timestamps. A value holds until the next sample, so rules
+# waiting out a duration are also checked against the clock: an unchanged
+# data buffer produces no new records, yet "temp > 80 for 10s" must still fire.
+class RuleEngine:
+    def __init__(self, config):
+        self.rules = {}  # Attribute -> rules on it
+        for rule_config in config:
+            rule = AlertRule(rule_config)
+            self.rules.setdefault(rule.attribute, []).append(rule)
+
+    # Returns (rule, active, timestamp, value) for every rule that fired or cleared
+    def evaluate(self, records):
+        changes = []
+        for timestamp, values in records:
+            now = None
+            for attribute, rules in self.rules.items():
+                value = values.get(attribute)
+                if type(value) is not int and type(value) is not float:
+                    continue
+                if now is None:
+                    now = timestamp.timestamp()
+                for rule in rules:
+                    active = rule.evaluate(value, now)
+                    if active is not None:
+                        changes.append((rule, active, timestamp, value))
+        return changes
+
+    # Re-evaluates the rules waiting out a duration against their latest
+    # values at wall-clock time now, returning changes like evaluate()
+    def check_pending(self, now):
+        changes = []
+        for rules in self.rules.values():
+            for rule in rules:
+                if rule.since is None:
+                    continue
+                active = rule.evaluate(rule.value, now)
+                if active is not None:
+                    changes.append((rule, active, datetime.fromtimestamp(now, timezone.utc), rule.value))
+        return changes
+
+    # Returns the earliest wall-clock time a pending rule changes state, or None
+    def next_due_time(self):
+        due_times = [rule.due_time() for rules in self.rules.values() for rule in rules if rule.since is not None]
+        return min(due_times) if due_times else None
+
+
+# Creates the rule engine, or returns None if there are no rules
+def create_rule_engine():
+    if not ALERT_RULES:
+        return None
+    return RuleEngine(ALERT_RULES)
+
+
+# ============================================================================
+# Windowed Aggregation
+# ============================================================================
+
+AGGREGATE_STATISTICS = {
+    "min": lambda window, count: float(window.min()),
+    "max": lambda window, count: float(window.max()),
+    "avg": lambda window, count: float(window.mean()),
+    "stddev": lambda window, count: float(window.std()),
+    "count": lambda window, count: count,
+}
+
+
+# Summarizes high-rate numeric attributes once per tick instead of sending
+# every sample. Each attribute has a preallocated NumPy ring buffer, so adding
+# a sample is one array store and nothing grows between ticks. The statistics
+# are computed vectorized over the window and sent as derived attributes
+# named <attribute>_<statistic>, e.g. temp_avg and temp_max.
+class WindowAggregator:
+    def __init__(self, config):
+        self.statistics = {name: list(statistics or AGGREGATE_STATISTICS) for name, statistics in config.items()}
+        self.windows = {name: numpy.empty(AGGREGATE_WINDOW_SIZE) for name in config}
+        self.counts = dict.fromkeys(config, 0)
+
+    # Stores the aggregated attributes of a sample and returns the rest
+    def add(self, values):
+        remaining = values
+        for name, value in values.items():
+            window = self.windows.get(name)
+            if window is None:
+                continue
+            if remaining is values:
+                remaining = dict(values)
+            del remaining[name]
+            if type(value) is int or type(value) is float:
+                count = self.counts[name]
+                window[count % AGGREGATE_WINDOW_SIZE] = value
+                self.counts[name] = count + 1
+            else:
+                stats["aggregate_non_numeric_samples"] += 1
+        return remaining
+
+    # Returns the statistics of every attribute sampled since the last call,
+    # and starts a new window
+    def summarize(self):
+        summary = {}
+        for name, window in self.windows.items():
+            count = self.counts[name]
+            if not count:
+                continue
+            samples = window[:min(count, AGGREGATE_WINDOW_SIZE)]
+            for statistic in self.statistics[name]:
+                summary[f"{name}_{statistic}"] = AGGREGATE_STATISTICS[statistic](samples, count)
+            self.counts[name] = 0
+        return summary
+
+
+# Creates the aggregator, or returns None if no attributes are aggregated
+def create_aggregator():
+    if not AGGREGATE_ATTRIBUTES:
+        return None
+    if numpy is None:
+        print("NumPy is not installed. Sending AGGREGATE_ATTRIBUTES as raw samples.")
+        return None
+    return WindowAggregator(AGGREGATE_ATTRIBUTES)
+
+
+# ============================================================================
+# Percentile Sketches
+# ============================================================================
+
+# DDSketch: a mergeable quantile sketch with a relative error guarantee. Each
+# value is counted in a logarithmic bucket, so memory depends on the range of
+# the values rather than how many there are, and any quantile is within
+# SKETCH_RELATIVE_ACCURACY of the true value.
+class QuantileSketch:
+    MIN_VALUE = 1e-9  # Values closer to zero than this count as zero
+
+    def __init__(self):
+        gamma = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+        self.log_gamma = math.log(gamma)
+        self.bucket_scale = 2 / (1 + gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value):
+        if value > self.MIN_VALUE:
+            self.add_to_bucket(self.positive, value)
+        elif value < -self.MIN_VALUE:
+            self.add_to_bucket(self.negative, -value)
+        else:
+            self.zeros += 1
+        self.count += 1
+
+    def add_to_bucket(self, buckets, magnitude):
+        index = math.ceil(math.log(magnitude) / self.log_gamma)
+        buckets[index] = buckets.get(index, 0) + 1
+        if len(buckets) > SKETCH_MAX_BINS:
+            self.collapse(buckets)
+
+    # Merges the buckets of the smallest magnitudes, keeping memory bounded
+    # while the high percentiles stay accurate
+    @staticmethod
+    def collapse(buckets):
+        indexes = sorted(buckets)
+        excess = len(indexes) - SKETCH_MAX_BINS
+        target = indexes[excess]
+        for index in indexes[:excess]:
+            buckets[target] += buckets.pop(index)
+
+    def merge(self, other):
+        for buckets, other_buckets in ((self.positive, other.positive), (self.negative, other.negative)):
+            for index, count in other_buckets.items():
+                buckets[index] = buckets.get(index, 0) + count
+            if len(buckets) > SKETCH_MAX_BINS:
+                self.collapse(buckets)
+        self.zeros += other.zeros
+        self.count += other.count
+
+    # Returns the value at quantile q (0 to 1)
+    def quantile(self, q):
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return -self.bucket_value(index)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self.bucket_value(index)
+        return self.bucket_value(max(self.positive)) if self.positive else 0.0
+
+    def bucket_value(self, index):
+        return self.bucket_scale * math.exp(index * self.log_gamma)
+
+    # JSON-friendly state (bucket indexes as [index, count] pairs)
+    def to_dict(self):
+        return {"positive": list(self.positive.items()), "negative": list(self.negative.items()),
+                "zeros": self.zeros, "count": self.count}
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls()
+        sketch.positive = {index: count for index, count in state["positive"]}
+        sketch.negative = {index: count for index, count in state["negative"]}
+        sketch.zeros = state["zeros"]
+        sketch.count = state["count"]
+        return sketch
+
+
+# Sends percentiles of latency-like attributes once per tick instead of every
+# sample. Each attribute has a QuantileSketch covering the samples since the
+# last tick, sent as derived attributes named <attribute>_p<percentile>, e.g.
+# latency_ms_p99.
+class SketchAggregator:
+    def __init__(self, config):
+        self.percentiles = {name: list(percentiles or SKETCH_PERCENTILES) for name, percentiles in config.items()}
+        self.sketches = {name: QuantileSketch() for name in config}
+
+    # Adds the sketched attributes of a sample to their sketches and returns the rest
+    def add(self, values):
+        remaining = values
+        for name, value in values.items():
+            sketch = self.sketches.get(name)
+            if sketch is None:
+                continue
+            if remaining is values:
+                remaining = dict(values)
+            del remaining[name]
+            if type(value) is int or type(value) is float:
+                sketch.add(value)
+            else:
+                stats["sketch_non_numeric_samples"] += 1
+        return remaining
+
+    # Returns the percentiles of every attribute sampled since the last call,
+    # and starts new sketches
+    def summarize(self):
+        summary = {}
+        for name, sketch in self.sketches.items():
+            if not sketch.count:
+                continue
+            for percentile in self.percentiles[name]:
+                summary[f"{name}_p{percentile}"] = sketch.quantile(percentile / 100)
+            self.sketches[name] = QuantileSketch()
+        return summary
+
+    def save(self, path):
+        with open(path, "w") as f:
+            f.write(json_dumps({name: sketch.to_dict() for name, sketch in self.sketches.items() if sketch.count}))
+
+    # Merges the sketches saved before a restart into the current ones
+    def restore(self, path):
+        try:
+            with open(path, "r") as f:
+                state = json_loads(f.read())
+            for name, saved in state.items():
+                if name in self.sketches:
+                    self.sketches[name].merge(QuantileSketch.from_dict(saved))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Unable to restore the percentile sketches: {e}")
+        os.remove(path)
+
+
+# Creates the sketch aggregator, restoring the sketches saved before a
+# restart, or returns None if no attributes are sketched
+def create_sketch_aggregator():
+    if not SKETCH_ATTRIBUTES:
+        return None
+    sketch_aggregator = SketchAggregator(SKETCH_ATTRIBUTES)
+    if os.path.exists(SKETCH_STATE_PATH):
+        sketch_aggregator.restore(SKETCH_STATE_PATH)
+    return sketch_aggregator
+
+
+# ============================================================================
+# Waveform Features
+# ============================================================================
+
+# Returns the /dev/shm path of a "shm:<name>" waveform source, or None for a
+# side file. Raises ValueError if the name could reach outside /dev/shm.
+def shared_memory_path(source):
+    if not source.startswith("shm:"):
+        return None
+    segment = source[len("shm:"):]
+    if not segment or "/" in segment:
+        raise ValueError(f"Invalid shared memory segment name {segment!r}")
+    return "/dev/shm/" + segment
+
+
+# Removes the /dev/shm segment of a waveform that is dropped unread
+def discard_waveform(source):
+    stats["waveforms_dropped"] += 1
+    try:
+        path = shared_memory_path(source)
+        if path is not None:
+            os.remove(path)
+    except (ValueError, OSError):
+        pass
+
+
+# Reads the samples of a waveform file, raising ValueError if it holds more
+# than WAVEFORM_MAX_SAMPLES
+def read_waveform(path, config):
+    dtype = numpy.dtype(config.get("dtype", "float32"))
+    if os.path.getsize(path) > WAVEFORM_MAX_SAMPLES * dtype.itemsize:
+        raise ValueError(f"{path} holds more than {WAVEFORM_MAX_SAMPLES} samples")
+    return numpy.fromfile(path, dtype=dtype).astype(numpy.float64)
+
+
+# Computes the features of one waveform: RMS, crest factor, peak frequency and
+# the energy in each configured frequency band. Runs in a worker process so
+# the FFT never holds the agent's GIL. The agent is the only reader of a
+# /dev/shm segment, so the segment is unlinked once read to free its RAM; a
+# side file is left to the producer that wrote it.
+def compute_waveform_features(name, source, config):
+    path = shared_memory_path(source)
+    if path is not None:
+        try:
+            samples = read_waveform(path, config)
+        finally:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    else:
+        samples = read_waveform(source, config)
+    if not samples.size:
+        return {}
+    rms = float(numpy.sqrt(numpy.mean(samples ** 2)))
+    power = numpy.abs(numpy.fft.rfft(samples - samples.mean())) ** 2 / samples.size
+    frequencies = numpy.fft.rfftfreq(samples.size, 1 / config["sample_rate"])
+    features = {
+        f"{name}_rms": rms,
+        f"{name}_crest": float(numpy.abs(samples).max() / rms) if rms else 0.0,
+        f"{name}_peak_hz": float(frequencies[power.argmax()]),
+    }
+    for low, high in config.get("bands", []):
+        band = (frequencies >= low) & (frequencies < high)
+        features[f"{name}_band_{low}_{high}"] = float(power[band].sum())
+    return features
+
+
+# Replaces waveform attributes with their features. Producers write the raw
+# samples to a side file (or /dev/shm) and put its path in the attribute; the
+# FFT runs on a process pool and the features are handed to on_features with
+# the sample's timestamp when ready, so the event loop, MQTT keepalives and
+# command handling are never delayed by it.
+class WaveformProcessor:
+    def __init__(self, config, on_features):
+        self.config = config
+        self.on_features = on_features
+        self.pending = 0
+        # Fork explicitly: this script can't be re-imported by a spawned worker.
+        # Ctrl+C is left to the agent, which shuts the pool down with close().
+        self.pool = concurrent.futures.ProcessPoolExecutor(WAVEFORM_WORKERS, mp_context=multiprocessing.get_context("fork"),
+                                                           initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
+        # Start the workers now, before the SDK starts any threads
+        self.pool.submit(int).result()
+
+    # Submits the waveform attributes of the records and returns the records
+    # left with any other attributes
+    def submit(self, records):
+        result = []
+        for timestamp, values in records:
+            remaining = {}
+            for name, value in values.items():
+                config = self.config.get(name)
+                if config is None:
+                    remaining[name] = value
+                elif type(value) is not str:
+                    stats["waveforms_dropped"] += 1
+                elif self.pool is None or self.pending >= WAVEFORM_WORKERS * 4:
+                    discard_waveform(value)
+                else:
+                    try:
+                        future = event_loop.run_in_executor(self.pool, compute_waveform_features, name, value, config)
+                    except concurrent.futures.process.BrokenProcessPool:
+                        self.pool_broken()
+                        discard_waveform(value)
+                        continue
+                    self.pending += 1
+                    future.add_done_callback(lambda future, timestamp=timestamp, name=name: self.finished(future, timestamp, name))
+            if remaining:
+                result.append((timestamp, remaining))
+        return result
+
+    def finished(self, future, timestamp, name):
+        self.pending -= 1
+        try:
+            features = future.result()
+        except asyncio.CancelledError:
+            return  # Dropped by close()
+        except concurrent.futures.process.BrokenProcessPool:
+            stats["waveform_errors"] += 1
+            self.pool_broken()
+            return
+        except Exception as e:
+            stats["waveform_errors"] += 1
+            print(f"Unable to compute features of waveform {name}: {e}")
+            return
+        if features:
+            self.on_features(timestamp, features)
+
+    # A worker process that died (e.g. killed when memory ran out) breaks the
+    # pool for good. Forking new workers isn't safe now that the SDK runs
+    # threads, so waveforms are dropped until the agent restarts.
+    def pool_broken(self):
+        if self.pool is None:
+            return
+        stats["waveform_pool_failures"] += 1
+        print("A waveform worker process died. Dropping waveforms until the agent restarts.")
+        self.pool = None
+
+    # Stops the worker processes, dropping the waveforms not yet started
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+
+
+# Creates the waveform processor, or returns None if no waveform attributes are configured
+def create_waveform_processor(on_features):
+    if not WAVEFORM_ATTRIBUTES:
+        return None
+    if numpy is None:
+        print("NumPy is not installed. Dropping WAVEFORM_ATTRIBUTES.")
+        return None
+    return WaveformProcessor(WAVEFORM_ATTRIBUTES, on_features)
+
+
+# ============================================================================
+# Tick Scheduling
+# ============================================================================
+
+# Schedules telemetry ticks on fixed deadlines of time.monotonic(), so the
+# period doesn't drift by however long each cycle takes. Ticks missed during a
+# stall are skipped or run back to back according to MISSED_TICK_POLICY.
+class TickScheduler:
+    def __init__(self, period):
+        self.period = period
+        self.next_tick = time.monotonic()
+        if ALIGN_TO_WALL_CLOCK:
+            self.align()
+
+    # Returns True if the next tick's deadline has passed
+    def due(self):
+        return time.monotonic() >= self.next_tick
+
+    # Moves on to the following tick once the current one was run
+    def advance(self):
+        self.next_tick += self.period
+        now = time.monotonic()
+        if self.next_tick <= now:
+            missed = int((now - self.next_tick) // self.period) + 1
+            if MISSED_TICK_POLICY == "burst":
+                # Keep the missed deadlines so they run immediately, up to the cap
+                missed = max(0, missed - MAX_BURST_TICKS)
+            if missed:
+                print(f"Skipping {missed} missed telemetry tick(s)")
+                self.next_tick += missed * self.period
+        if ALIGN_TO_WALL_CLOCK:
+            self.align()
+
+    # Shifts the next tick onto a wall-clock multiple of the period. Applied on
+    # every tick, which also follows NTP corrections of the wall clock.
+    def align(self):
+        wall_at_tick = time.time() + (self.next_tick - time.monotonic())
+        error = wall_at_tick - round(wall_at_tick / self.period) * self.period
+        self.next_tick -= error
+
+
+# ============================================================================
+# Telemetry Transforms
+# ============================================================================
+
+# Linear unit conversions as (factor, offset)
+UNIT_CONVERSIONS = {
+    "degF->degC": (5 / 9, -160 / 9),
+    "degC->degF": (9 / 5, 32),
+    "K->degC": (1, -273.15),
+    "degC->K": (1, 273.15),
+    "psi->kPa": (6.894757, 0),
+    "kPa->psi": (1 / 6.894757, 0),
+    "bar->kPa": (100, 0),
+    "kPa->bar": (0.01, 0),
+    "in->mm": (25.4, 0),
+    "mm->in": (1 / 25.4, 0),
+    "mph->km/h": (1.609344, 0),
+    "km/h->mph": (1 / 1.609344, 0),
+    "m/s->km/h": (3.6, 0),
+    "mA->A": (0.001, 0),
+    "Wh->kWh": (0.001, 0),
+}
+
+# What transform expressions may use besides attribute names and numbers
+EXPRESSION_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+EXPRESSION_FUNCTIONS = {"abs": abs, "min": min, "max": max, "round": round, "sqrt": math.sqrt}
+
+
+# Compiles an arithmetic expression over attributes, e.g. "voltage * current",
+# into a closure taking the values. Only numbers, attribute names, the
+# operators and the functions above are allowed, so nothing is ever eval'd.
+def compile_expression(expression):
+    def compile_node(node):
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            constant = node.value
+            return lambda values: constant
+        if isinstance(node, ast.Name):
+            name = node.id
+            return lambda values: values[name]
+        if isinstance(node, ast.BinOp) and type(node.op) in EXPRESSION_OPERATORS:
+            function, left, right = EXPRESSION_OPERATORS[type(node.op)], compile_node(node.left), compile_node(node.right)
+            return lambda values: function(left(values), right(values))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in EXPRESSION_OPERATORS:
+            function, operand = EXPRESSION_OPERATORS[type(node.op)], compile_node(node.operand)
+            return lambda values: function(operand(values))
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in EXPRESSION_FUNCTIONS
+                and not node.keywords):
+            function, arguments = EXPRESSION_FUNCTIONS[node.func.id], [compile_node(argument) for argument in node.args]
+            return lambda values: function(*[argument(values) for argument in arguments])
+        raise ValueError(f"Unsupported syntax in transform expression {expression!r}")
+
+    try:
+        tree = ast.parse(expression, mode="eval")
+    except SyntaxError as e:
+        raise ValueError(f"Invalid transform expression {expression!r}: {e}")
+    return compile_node(tree.body)
+
+
+# Turns raw producer values (register readings, nested objects, other units)
+# into the attributes the template expects. TRANSFORMS is compiled once into
+# a flat list of operations on a copy of each record: renames, linear
+# conversions (scale, offset and unit folded into one multiply-add),
+# flattening, and then the computed expressions in the order listed.
+class TransformPlan:
+    def __init__(self, config):
+        self.operations = []
+        computed = []
+        for key, spec in config.items():
+            if "expression" in spec:
+                computed.append(self.computed(key, compile_expression(spec["expression"])))
+                continue
+            target = spec.get("rename", key)
+            if spec.get("flatten"):
+                self.operations.append(self.flattened(key, target))
+                continue
+            factor, offset = spec.get("scale", 1), spec.get("offset", 0)
+            if "unit" in spec:
+                unit_factor, unit_offset = UNIT_CONVERSIONS[spec["unit"]]
+                factor, offset = factor * unit_factor, offset * unit_factor + unit_offset
+            if factor != 1 or offset:
+                self.operations.append(self.converted(key, target, factor, offset))
+            elif target != key:
+                self.operations.append(self.renamed(key, target))
+        self.operations += computed
+
+    # Returns the transformed values
+    def apply(self, values):
+        values = dict(values)
+        for operation in self.operations:
+            operation(values)
+        return values
+
+    @staticmethod
+    def renamed(key, target):
+        def operation(values):
+            if key in values:
+                values[target] = values.pop(key)
+        return operation
+
+    @staticmethod
+    def converted(key, target, factor, offset):
+        def operation(values):
+            if key not in values:
+                return
+            value = values.pop(key)
+            if type(value) is int or type(value) is float:
+                values[target] = value * factor + offset
+            else:
+                stats["transform_non_numeric_values"] += 1
+        return operation
+
+    @staticmethod
+    def flattened(key, target):
+        def flatten(prefix, obj, values):
+            for name, value in obj.items():
+                if isinstance(value, dict):
+                    flatten(f"{prefix}_{name}", value, values)
+                else:
+                    values[f"{prefix}_{name}"] = value
+
+        def operation(values):
+            if isinstance(values.get(key), dict):
+                flatten(target, values.pop(key), values)
+        return operation
+
+    # Only finite numbers are kept: e.g. a negative number raised to a
+    # fractional power is complex, which can't be sent as JSON
+    @staticmethod
+    def computed(target, evaluate):
+        def operation(values):
+            try:
+                value = evaluate(values)
+            except KeyError:
+                return  # An input isn't in this record
+            except (TypeError, ValueError, ArithmeticError):
+                stats["transform_errors"] += 1
+                return
+            if (type(value) is int or type(value) is float) and math.isfinite(value):
+                values[target] = value
+            else:
+                stats["transform_errors"] += 1
+        return operation
+
+
+# Creates the transform plan, or returns None if there are no transforms
+def create_transform_plan():
+    if not TRANSFORMS:
+        return None
+    return TransformPlan(TRANSFORMS)
+
+
+# ============================================================================
+# Telemetry Filtering
+# ============================================================================
+
+# Applies a per-record stage to a list of (timestamp, values) records,
+# dropping the records it leaves without any attributes
+def apply_stage(records, stage):
+    result = []
+    for timestamp, values in records:
+        values = stage(values)
+        if values:
+            result.append((timestamp, values))
+    return result
+
+
+# Converts a value to the template's INTEGER/LONG type, raising ValueError or
+# TypeError if it can't be. Each converter returns early for the common case.
+def to_integer(value):
+    if type(value) is int:
+        return value
+    if type(value) is float and value.is_integer():
+        return int(value)
+    if type(value) is str or type(value) is bool:
+        return int(value)
+    raise TypeError(f"{type(value).__name__} is not an integer")
+
+
+def to_decimal(value):
+    if type(value) is float:
+        return value
+    if type(value) in (int, str):
+        return float(value)
+    raise TypeError(f"{type(value).__name__} is not a decimal")
+
+
+def to_string(value):
+    if type(value) is str:
+        return value
+    if type(value) in (int, float, bool):
+        return str(value)
+    raise TypeError(f"{type(value).__name__} is not a string")
+
+
+def to_boolean(value):
+    if type(value) is bool:
+        return value
+    if value in (0, 1):
+        return bool(value)
+    if type(value) is str and value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    raise ValueError(f"{value!r} is not a boolean")
+
+
+TEMPLATE_CONVERTERS = {
+    "INTEGER": to_integer,
+    "LONG": to_integer,
+    "DECIMAL": to_decimal,
+    "STRING": to_string,
+    "BOOLEAN": to_boolean,
+    "BIT": to_integer,
+}
+
+
+# Validates records against the attributes of the device template, compiled
+# once into a dict of attribute name -> converter so each record costs one
+# lookup and one call per key. Unknown attributes and values that can't be
+# converted are dropped and counted. Types without a converter (DATE, LATLONG,
+# ...) are passed through unchanged, and OBJECT attributes are validated
+# against their member attributes.
+class TemplateValidator:
+    def __init__(self, attributes):
+        self.converters = {}
+        for attribute in attributes:
+            data_type = str(attribute.get("type", "")).upper()
+            if data_type == "OBJECT":
+                self.converters[attribute["name"]] = TemplateValidator(attribute.get("childs") or []).convert_object
+            else:
+                self.converters[attribute["name"]] = TEMPLATE_CONVERTERS.get(data_type)
+
+    # Returns values with unknown attributes dropped and values converted
+    def apply(self, values):
+        result = {}
+        converters = self.converters
+        for key, value in values.items():
+            try:
+                converter = converters[key]
+            except KeyError:
+                stats["rejected_unknown_attributes"] += 1
+                continue
+            if converter is not None:
+                try:
+                    value = converter(value)
+                except (TypeError, ValueError):
+                    stats["rejected_attribute_values"] += 1
+                    continue
+            result[key] = value
+        return result
+
+    def convert_object(self, value):
+        if type(value) is not dict:
+            raise TypeError("not an object")
+        return self.apply(value)
+
+
+# Loads TEMPLATE_PATH (an exported device template, or just its list of
+# attributes) into a validator, or returns None if no template is configured
+def create_template_validator():
+    if not TEMPLATE_PATH:
+        return None
+    with open(TEMPLATE_PATH, "r") as f:
+        template = json.load(f)
+    attributes = template["attributes"] if isinstance(template, dict) else template
+    print(f"Validating telemetry against {len(attributes)} template attributes from {TEMPLATE_PATH}")
+    return TemplateValidator(attributes)
+
+
+# Drops attributes that haven't moved meaningfully since they were last sent.
+# A numeric attribute is sent when it moved by more than its "absolute"
+# deadband or more than "percent" of its last sent value (any change if
+# neither is set), any other attribute when it changed, and every attribute
+# once it has been silent for its "max_silence" seconds (MAX_SILENCE by default).
+# Silence is checked every cycle against the last value seen, so an attribute
+# that stopped changing (and so isn't read again) still goes out on time.
+# Attributes without a deadband (and no "*" entry) are always sent.
+class DeadbandFilter:
+    def __init__(self, config):
+        # Compile once into (absolute, fraction, max_silence) tuples
+        self.bands = {
+            key: (band.get("absolute"), band["percent"] / 100 if "percent" in band else None, band.get("max_silence", MAX_SILENCE))
+            for key, band in config.items()
+        }
+        self.default_band = self.bands.pop("*", None)
+        self.last_sent = {}  # Attribute -> (value, monotonic time it was sent)
+        self.last_seen = {}  # Attribute -> latest value, sent or not
+
+    # Returns the attributes of values that should be sent
+    def apply(self, values):
+        now = time.monotonic()
+        result = {}
+        for key, value in values.items():
+            band = self.bands.get(key, self.default_band)
+            if band is not None:
+                self.last_seen[key] = value
+                last = self.last_sent.get(key)
+                if last is not None and now - last[1] < band[2] and not self.moved(value, last[0], band):
+                    continue
+                self.last_sent[key] = (value, now)
+            result[key] = value
+        return result
+
+    # Returns the latest values of the attributes whose silence timer ran out
+    def check_silence(self):
+        now = time.monotonic()
+        result = {}
+        for key, value in self.last_seen.items():
+            if now - self.last_sent[key][1] >= self.bands.get(key, self.default_band)[2]:
+                self.last_sent[key] = (value, now)
+                result[key] = value
+        return result
+
+    # Monotonic time at which the next silence timer runs out, or None
+    def next_due_time(self):
+        return min((sent_time + self.bands.get(key, self.default_band)[2] for key, (_, sent_time) in self.last_sent.items()),
+                   default=None)
+
+    @staticmethod
+    def moved(value, last_value, band):
+        absolute, fraction, _ = band
+        numeric = (int, float)
+        if not isinstance(value, numeric) or not isinstance(last_value, numeric) or isinstance(value, bool):
+            return value != last_value
+        change = abs(value - last_value)
+        if absolute is None and fraction is None:
+            return change > 0
+        return (absolute is not None and change > absolute) or (fraction is not None and change > fraction * abs(last_value))
+
+
+# Creates the deadband filter, or returns None if no deadbands are configured
+def create_deadband_filter():
+    if not DEADBANDS:
+        return None
+    return DeadbandFilter(DEADBANDS)
+
+
+# Reduces each record to the attributes whose values differ from what was
+# last sent. Once DELTA_SNAPSHOT_EVERY telemetry messages have gone out, the
+# next record is sent as a full snapshot instead so the cloud can
+# resynchronize after a lost message. The snapshot is the latest data buffer
+# content plus the record itself, rebuilt each time, so attributes producers
+# stopped writing and past per-tick summaries are never repeated.
+class DeltaEncoder:
+    def __init__(self):
+        self.sent = {}  # Last value sent for every attribute
+        self.messages = DELTA_SNAPSHOT_EVERY  # Telemetry messages sent since the last snapshot; the first record is one
+
+    def snapshot_due(self):
+        return self.messages >= DELTA_SNAPSHOT_EVERY
+
+    # Returns the payload to send for values, which is empty if nothing
+    # changed. snapshot is the latest data buffer content (or None), used
+    # when a full snapshot is due.
+    def encode(self, values, snapshot):
+        if self.snapshot_due():
+            payload = {**(snapshot or {}), **values}
+            self.sent = dict(payload)
+            self.messages = 0
+            return payload
+        sent = self.sent
+        payload = {key: value for key, value in values.items() if key not in sent or sent[key] != value}
+        sent.update(payload)
+        return payload
+
+
+# Creates the delta encoder, or returns None if full payloads are sent
+def create_delta_encoder():
+    if not DELTA_PAYLOADS:
+        return None
+    return DeltaEncoder()
+
+
+# ============================================================================
+# Telemetry Batching
+# ============================================================================
+
+# Collects records so several timestamped samples are sent per telemetry
+# message, amortizing the per-message TLS, MQTT and billing overhead. A batch
+# is sent once it reaches its record or byte limit, or once its oldest record
+# has waited the allowed latency. The limits start at BATCH_MAX_RECORDS,
+# BATCH_MAX_BYTES and BATCH_MAX_LATENCY and stretch together (up to
+# BATCH_MAX_STRETCH times) when publishing is slow, so slow (e.g. cellular)
+# links send fewer, larger messages. A publish is timed until the broker
+# acknowledges it: the SDK only queues the message, so timing the call itself
+# would say nothing about the link.
+class TelemetryBatcher:
+    def __init__(self):
+        self.records = []
+        self.sizes = []
+        self.size = 0
+        self.oldest_time = None
+        self.publish_seconds = 0.0  # Moving average of how long the broker takes to acknowledge a publish
+        self.unacknowledged = []  # (MQTT message info, monotonic time it was sent)
+
+    def add(self, records):
+        if records and self.oldest_time is None:
+            self.oldest_time = time.monotonic()
+        for timestamp, values in records:
+            size = len(json_dumps(values))
+            self.records.append((timestamp, values))
+            self.sizes.append(size)
+            self.size += size
+
+    # Factor the batch limits are multiplied by: 1 while publishing takes at
+    # most BATCH_PUBLISH_DUTY of BATCH_MAX_LATENCY, growing with the publish time
+    def stretch(self):
+        if BATCH_PUBLISH_DUTY <= 0:
+            return 1
+        return min(BATCH_MAX_STRETCH, max(1, self.publish_seconds / (BATCH_PUBLISH_DUTY * BATCH_MAX_LATENCY)))
+
+    # Seconds the oldest record may wait
+    def max_latency(self):
+        return BATCH_MAX_LATENCY * self.stretch()
+
+    # Monotonic time by which the pending records must be sent, or None when empty
+    def flush_deadline(self):
+        if self.oldest_time is None:
+            return None
+        return self.oldest_time + self.max_latency()
+
+    # Removes and returns every batch that is due to be sent
+    def take_due_batches(self):
+        batches = []
+        stretch = self.stretch()
+        max_records, max_bytes = int(BATCH_MAX_RECORDS * stretch), int(BATCH_MAX_BYTES * stretch)
+        while self.records and (len(self.records) >= max_records or self.size >= max_bytes
+                                or time.monotonic() >= self.flush_deadline()):
+            count, size = 0, 0
+            while count < min(len(self.records), max_records) and (count == 0 or size + self.sizes[count] <= max_bytes):
+                size += self.sizes[count]
+                count += 1
+            batches.append(self.records[:count])
+            del self.records[:count]
+            del self.sizes[:count]
+            self.size -= size
+            self.oldest_time = time.monotonic() if self.records else None
+        return batches
+
+    # Removes and returns every pending record, due or not
+    def take_all(self):
+        records = self.records
+        self.records, self.sizes, self.size, self.oldest_time = [], [], 0, None
+        return records
+
+    # Starts timing a publish from the MQTT message info the SDK returned
+    # (None if the message wasn't sent, or from SDKs that don't return it)
+    def time_publish(self, info):
+        if info is not None and info.rc == 0:
+            self.unacknowledged.append((info, time.monotonic()))
+
+    # Feeds the publishes the broker acknowledged since the last call into the
+    # moving average. The acks of messages sent before a disconnect are
+    # forgotten, as their time would measure the outage rather than the link.
+    def check_acknowledgements(self):
+        if not c.is_connected():
+            self.unacknowledged.clear()
+            return
+        now = time.monotonic()
+        waiting = []
+        for info, sent_time in self.unacknowledged:
+            if info.is_published():
+                self.publish_seconds += 0.2 * (now - sent_time - self.publish_seconds)
+            else:
+                waiting.append((info, sent_time))
+        self.unacknowledged = waiting
+
+
+# Creates the batcher, or returns None if every record is sent on its own
+def create_batcher():
+    if BATCH_MAX_RECORDS <= 1:
+        return None
+    return TelemetryBatcher()
+
+
+# Sends a list of (timestamp, values) records as a single telemetry message,
+# timing it until the broker acknowledges it when batching and counting it
+# towards the next delta snapshot
+def send_batch(batch):
+    info = c.send_telemetry_records([TelemetryRecord(values=values, timestamp=timestamp) for timestamp, values in batch])
+    if batcher is not None:
+        batcher.time_publish(info)
+    if delta_encoder is not None:
+        delta_encoder.messages += 1
+
+
+# ============================================================================
+# Store and Forward
+# ============================================================================
+
+# Disk-backed FIFO of telemetry records produced while disconnected, kept in
+# SQLite (WAL mode, so a power cut loses at most the last transaction). Records
+# keep their original timestamps and are sent oldest first at
+# OFFLINE_DRAIN_RATE messages per second once reconnected. Beyond
+# OFFLINE_QUEUE_MAX_RECORDS the oldest records are evicted.
+class OfflineQueue:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS records (id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp REAL, payload TEXT)")
+        self.count = self.db.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+        self.tokens = 0.0
+        self.last_drain = time.monotonic()
+        if self.count:
+            print(f"{self.count} telemetry records queued from a previous run")
+
+    def push(self, records):
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany("INSERT INTO records (timestamp, payload) VALUES (?, ?)",
+                                [(timestamp.timestamp(), json_dumps(values)) for timestamp, values in records])
+        self.count += len(records)
+        if self.count > OFFLINE_QUEUE_MAX_RECORDS:
+            evicted = self.count - OFFLINE_QUEUE_MAX_RECORDS
+            self.db.execute("DELETE FROM records WHERE id IN (SELECT id FROM records ORDER BY id LIMIT ?)", (evicted,))
+            self.count -= evicted
+            stats["offline_records_evicted"] += evicted
+
+    # Sends as many queued messages as the drain rate allows since the last call
+    def drain(self):
+        now = time.monotonic()
+        self.tokens = min(OFFLINE_DRAIN_RATE, self.tokens + (now - self.last_drain) * OFFLINE_DRAIN_RATE)
+        self.last_drain = now
+        while self.count and self.tokens >= 1 and c.is_connected():
+            rows = self.db.execute("SELECT id, timestamp, payload FROM records ORDER BY id LIMIT ?",
+                                   (max(1, BATCH_MAX_RECORDS),)).fetchall()
+            send_batch([(datetime.fromtimestamp(timestamp, timezone.utc), json_loads(payload)) for _, timestamp, payload in rows])
+            self.db.execute("DELETE FROM records WHERE id <= ?", (rows[-1][0],))
+            self.count -= len(rows)
+            self.tokens -= 1
+            stats["offline_records_sent"] += len(rows)
+            if not self.count:
+                print("Sent all queued telemetry")
+
+    def close(self):
+        self.db.close()
+
+
+# Opens the offline queue, or returns None if telemetry isn't queued while disconnected
+def create_offline_queue():
+    if not OFFLINE_QUEUE_PATH:
+        return None
+    return OfflineQueue(OFFLINE_QUEUE_PATH)
+
+
+# Sends a batch, or queues it while disconnected and while older queued
+# records are still waiting so that records always reach the cloud in order.
+# Returns True if the batch was sent.
+def publish(batch):
+    if offline_queue is not None and (offline_queue.count or not c.is_connected()):
+        offline_queue.push(batch)
+        return False
+    send_batch(batch)
+    return True
+
+
 # ============================================================================
 # OTA Package Management
 # ============================================================================
 
+# Publishes the records still waiting in the outbox and batcher, so none are
+# lost when the agent exits or restarts
+def flush_pending():
+    pending = (batcher.take_all() if batcher is not None else []) + outbox
+    outbox.clear()
+    if pending and (c.is_connected() or offline_queue is not None):
+        publish(pending)
+
+
+# Restarts the process to apply updates. Pending records are sent and the
+# percentile sketches saved first, from the event loop that owns them, so
+# neither is lost over the restart.
+def restart_application():
+    asyncio.run_coroutine_threadsafe(prepare_restart(), event_loop).result()
+    os.execv(sys.executable, [sys.executable, __file__] + [sys.argv[0]])
+
+
+async def prepare_restart():
+    flush_pending()
+    if waveform_processor is not None:
+        waveform_processor.close()
+    if sketch_aggregator is not None:
+        sketch_aggregator.save(SKETCH_STATE_PATH)
+
+
 # Handler for OTA packages
 def extract_and_run_tar_gz(targz_filename):
     try:
@@ -77,12 +1989,476 @@ def extract_and_run_tar_gz(targz_filename):
         return False
 
 
+# ============================================================================
+# Command Log
+# ============================================================================
+
+# Every forwarded command is appended to a JSON-lines log as
+# {"seq": n, "command_name": ..., "parameters": ..., "timestamp": ...}, with
+# seq increasing by one across segments and restarts. Segments are named by
+# their first seq. Each consumer keeps the last seq it processed in
+# consumers/<name>.offset, so it sees every command exactly once no matter
+# how quickly they arrive. A restart appends to the last segment, so a new
+# segment is only started every COMMAND_LOG_SEGMENT_RECORDS commands.
+# Segments every consumer is past are deleted, as are the oldest beyond
+# COMMAND_LOG_MAX_SEGMENTS.
+class CommandLog:
+    def __init__(self, directory):
+        self.directory = directory
+        self.consumers_dir = os.path.join(directory, "consumers")
+        os.makedirs(self.consumers_dir, exist_ok=True)
+        self.segments = sorted(int(name[:-len(".jsonl")]) for name in os.listdir(directory)
+                               if name.endswith(".jsonl") and name[:-len(".jsonl")].isdigit())
+        self.next_seq = self.last_seq() + 1
+        self.file = None
+        self.segment_records = COMMAND_LOG_SEGMENT_RECORDS
+        if self.segments:
+            # Keep appending to the last segment, unless its final line was torn
+            # by a crash: then start a new segment so it's never appended to
+            path = self.segment_path(self.segments[-1])
+            with open(path, "rb") as f:
+                content = f.read()
+            if not content or content.endswith(b"\n"):
+                self.file = open(path, "a")
+                self.segment_records = content.count(b"\n")
+        self.compact()
+
+    def segment_path(self, first_seq):
+        return os.path.join(self.directory, f"{first_seq:020d}.jsonl")
+
+    # Returns the seq of the last complete command in the log (0 if empty)
+    def last_seq(self):
+        for first_seq in reversed(self.segments):
+            with open(self.segment_path(first_seq), "rb") as f:
+                lines = f.read().splitlines()
+            for line in reversed(lines):
+                try:
+                    return json_loads(line)["seq"]
+                except (ValueError, KeyError, TypeError):
+                    continue
+        return 0
+
+    # Appends a command and returns its seq
+    def append(self, command):
+        if self.segment_records >= COMMAND_LOG_SEGMENT_RECORDS:
+            self.start_segment()
+        seq = self.next_seq
+        self.file.write(json_dumps({"seq": seq, **command}) + "\n")
+        self.file.flush()
+        self.next_seq += 1
+        self.segment_records += 1
+        return seq
+
+    def start_segment(self):
+        if self.file is not None:
+            self.file.close()
+        self.segments.append(self.next_seq)
+        self.file = open(self.segment_path(self.next_seq), "a")
+        self.segment_records = 0
+        self.compact()
+
+    # Returns the lowest seq every consumer has processed, or None if there
+    # are no consumers
+    def consumed_seq(self):
+        offsets = []
+        for name in os.listdir(self.consumers_dir):
+            if not name.endswith(".offset"):
+                continue
+            try:
+                with open(os.path.join(self.consumers_dir, name), "r") as f:
+                    offsets.append(int(f.read()))
+            except (OSError, ValueError):
+                continue
+        return min(offsets) if offsets else None
+
+    def compact(self):
+        consumed = self.consumed_seq()
+        while len(self.segments) > 1:
+            # A segment ends right before the next one's first seq
+            fully_consumed = consumed is not None and self.segments[1] - 1 <= consumed
+            if not fully_consumed and len(self.segments) <= COMMAND_LOG_MAX_SEGMENTS:
+                break
+            os.remove(self.segment_path(self.segments.pop(0)))
+            stats["command_log_segments_compacted"] += 1
+
+
+# Creates the command log, or returns None if it isn't enabled
+def create_command_log():
+    if not COMMAND_LOG_DIR:
+        return None
+    command_log = CommandLog(COMMAND_LOG_DIR)
+    print(f"Logging commands to {COMMAND_LOG_DIR} from seq {command_log.next_seq}")
+    return command_log
+
+
+# ============================================================================
+# Command Subscriptions
+# ============================================================================
+
+# A consumer connected to the command socket
+class CommandSubscriber:
+    def __init__(self):
+        self.partial = b""  # Unfinished subscribe line
+        self.names = set()
+        self.prefixes = []
+        self.backlog = b""  # Commands the socket couldn't take yet
+
+    def subscribe(self, patterns):
+        for pattern in patterns:
+            if pattern.endswith("*"):
+                self.prefixes.append(pattern[:-1])
+            else:
+                self.names.add(pattern)
+
+    def wants(self, command_name):
+        return command_name in self.names or any(command_name.startswith(prefix) for prefix in self.prefixes)
+
+
+# Local Unix socket that pushes commands to consumers instead of them polling
+# the command buffer. A consumer connects and sends one or more lines like
+# {"subscribe": ["reboot", "led-*"]} (a trailing * subscribes to a prefix,
+# "*" alone to everything), then receives every matching command as a JSON
+# line the moment it arrives. With deferred acks it sends each command's
+# result back as a {"ack_id": ..., "success": ..., "message": ...} line. Like
+# the data socket, it is serviced from the event loop with non-blocking sockets.
+class CommandSubscriptionServer:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if os.path.exists(path):
+            os.remove(path)  # Stale socket from a previous run
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen()
+        self.server.setblocking(False)
+        self.subscribers = {}  # Connected consumer socket -> CommandSubscriber
+        self.loop = None
+        self.on_result = None
+
+    # Services the sockets from the event loop, calling on_result (if given)
+    # with every command result a consumer sends
+    def attach(self, loop, on_result=None):
+        self.loop = loop
+        self.on_result = on_result
+        loop.add_reader(self.server, self.accept)
+
+    def accept(self):
+        try:
+            connection, _ = self.server.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        connection.setblocking(False)
+        self.subscribers[connection] = CommandSubscriber()
+        self.loop.add_reader(connection, self.read_connection, connection)
+
+    # Reads what a consumer sent and applies every complete subscribe line
+    def read_connection(self, connection):
+        try:
+            data = connection.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.close_connection(connection)
+            return
+
+        subscriber = self.subscribers[connection]
+        *lines, subscriber.partial = (subscriber.partial + data).split(b"\n")
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                message = json_loads(line)
+                if not isinstance(message, dict):
+                    raise TypeError("not a JSON object")
+                if "ack_id" in message and self.on_result is not None:
+                    self.on_result(message)
+                else:
+                    subscriber.subscribe([str(pattern) for pattern in message["subscribe"]])
+            except (ValueError, KeyError, TypeError) as e:
+                print(f"Ignoring invalid message on command socket: {e}")
+        if len(subscriber.partial) > 65536:
+            self.close_connection(connection)
+
+    # Pushes a command to every subscriber that wants it and returns how many
+    def publish(self, command):
+        line = (json_dumps(command) + "\n").encode()
+        delivered = 0
+        for connection, subscriber in list(self.subscribers.items()):
+            if subscriber.wants(command["command_name"]):
+                self.send(connection, subscriber, line)
+                delivered += 1
+        return delivered
+
+    def send(self, connection, subscriber, data):
+        if subscriber.backlog:
+            subscriber.backlog += data
+        else:
+            try:
+                sent = connection.send(data)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self.close_connection(connection)
+                return
+            if sent < len(data):
+                subscriber.backlog = data[sent:]
+                self.loop.add_writer(connection, self.flush, connection)
+        if len(subscriber.backlog) > COMMAND_SOCKET_MAX_BACKLOG:
+            print(f"Disconnecting command subscriber that fell {COMMAND_SOCKET_MAX_BACKLOG} bytes behind")
+            stats["command_subscribers_dropped"] += 1
+            self.close_connection(connection)
+
+    # Sends what a subscriber's socket couldn't take earlier
+    def flush(self, connection):
+        subscriber = self.subscribers[connection]
+        try:
+            sent = connection.send(subscriber.backlog)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.close_connection(connection)
+            return
+        subscriber.backlog = subscriber.backlog[sent:]
+        if not subscriber.backlog:
+            self.loop.remove_writer(connection)
+
+    def close_connection(self, connection):
+        del self.subscribers[connection]
+        self.loop.remove_reader(connection)
+        self.loop.remove_writer(connection)
+        connection.close()
+
+
+# Creates the command socket server, or returns None if it is not configured
+def create_command_server():
+    if not COMMAND_SOCKET_PATH:
+        return None
+    server = CommandSubscriptionServer(COMMAND_SOCKET_PATH)
+    print(f"Pushing commands to subscribers on {COMMAND_SOCKET_PATH}")
+    return server
+
+
+# ============================================================================
+# Command Routing
+# ============================================================================
+
+# In-process command handlers that COMMAND_ROUTES can name, e.g.
+# {"ping": {"handler": "ping"}}. A handler takes the command name and
+# arguments, runs on the command pool and returns the acknowledgement message,
+# so its commands are acknowledged with the real result even without
+# deferred acks.
+command_handlers = {}
+
+
+def command_handler(name):
+    def register(function):
+        command_handlers[name] = function
+        return function
+    return register
+
+
+@command_handler("ping")
+def handle_ping(command_name, command_args):
+    return "pong"
+
+
+# Creates the delivery function for a COMMAND_ROUTES destination
+def create_route(destination):
+    if "file" in destination:
+        path = destination["file"]
+
+        # Replaces the file atomically, so its consumer never reads half a command
+        def deliver_to_file(command_name, command_args, ack_id):
+            with open(path + ".tmp", "w") as f:
+                f.write(json_dumps(command_record(command_name, command_args, ack_id)))
+            os.replace(path + ".tmp", path)
+        return deliver_to_file
+
+    if "socket" in destination:
+        path = destination["socket"]
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+
+        # Sends one datagram to the consumer's bound socket; raises if it isn't listening
+        def deliver_to_socket(command_name, command_args, ack_id):
+            sock.sendto(json_dumps(command_record(command_name, command_args, ack_id)).encode(), path)
+        return deliver_to_socket
+
+    if "handler" in destination:
+        if destination["handler"] not in command_handlers:
+            raise ValueError(f"Unknown command handler {destination['handler']!r}")
+        handler = command_handlers[destination["handler"]]
+        return lambda command_name, command_args, ack_id: handler(command_name, command_args)
+
+    raise ValueError(f"Command route needs a file, socket or handler: {destination!r}")
+
+
+# Finds the route of a command, so each consumer only wakes up for its own
+# commands. Exact names are a dict lookup; globs (e.g. "led-*") are compiled
+# once and tried in the order listed only when no exact name matches.
+class CommandRouter:
+    def __init__(self, routes):
+        self.exact = {}
+        self.patterns = []
+        self.handler_routes = set()
+        for pattern, destination in routes.items():
+            route = create_route(destination)
+            if "handler" in destination:
+                self.handler_routes.add(route)
+            if any(char in pattern for char in "*?["):
+                self.patterns.append((re.compile(fnmatch.translate(pattern)).match, route))
+            else:
+                self.exact[pattern] = route
+
+    # Returns the delivery function for a command, or None if it has no route.
+    # It takes the command name, arguments and ack_id and returns the
+    # acknowledgement message of a handler, or None once forwarded.
+    def route(self, command_name):
+        route = self.exact.get(command_name)
+        if route is not None:
+            return route
+        for match, route in self.patterns:
+            if match(command_name):
+                return route
+        return None
+
+    # Returns True if a command is routed to an in-process handler
+    def runs_handler(self, command_name):
+        return self.route(command_name) in self.handler_routes
+
+
+# Creates the command router, or returns None if there are no routes
+def create_command_router():
+    if not COMMAND_ROUTES:
+        return None
+    return CommandRouter(COMMAND_ROUTES)
+
+
+# ============================================================================
+# Deferred Acknowledgements
+# ============================================================================
+
+# Acknowledges forwarded commands with the result their consumer reports
+# instead of as soon as they are forwarded. Each command's ack_id is waiting
+# in a heap ordered by deadline, so a consumer that never answers produces a
+# CMD_FAILED after COMMAND_ACK_TIMEOUT instead of a false success. Results
+# arrive as files in COMMAND_RESULT_DIR or as lines on the command socket.
+class CommandAckTracker:
+    def __init__(self, result_dir):
+        self.result_dir = result_dir
+        os.makedirs(result_dir, exist_ok=True)
+        self.pending = {}  # ack_id -> command message waiting for its result
+        self.deadlines = []  # Heap of (monotonic deadline, ack_id)
+
+    def expect(self, msg):
+        self.pending[msg.ack_id] = msg
+        heapq.heappush(self.deadlines, (time.monotonic() + COMMAND_ACK_TIMEOUT, msg.ack_id))
+
+    # Acknowledges the command a consumer's result is for
+    def resolve(self, result):
+        msg = self.pending.pop(result.get("ack_id"), None)
+        if msg is None:
+            stats["command_results_unexpected"] += 1
+            return
+        if result.get("success") is True:
+            c.send_command_ack(msg, C2dAck.CMD_SUCCESS_WITH_ACK, str(result.get("message", "Done")))
+        else:
+            c.send_command_ack(msg, C2dAck.CMD_FAILED, str(result.get("message", "Failed")))
+
+    # Resolves the result files consumers dropped and deletes them
+    def read_result_files(self):
+        for name in os.listdir(self.result_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.result_dir, name)
+            try:
+                with open(path, "rb") as f:
+                    result = json_loads(f.read())
+                os.remove(path)
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable command result {path}: {e}")
+                continue
+            if isinstance(result, dict):
+                self.resolve(result)
+
+    # Fails the commands whose consumers didn't answer in time
+    def expire(self):
+        now = time.monotonic()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, ack_id = heapq.heappop(self.deadlines)
+            msg = self.pending.pop(ack_id, None)
+            if msg is not None:
+                stats["command_acks_timed_out"] += 1
+                c.send_command_ack(msg, C2dAck.CMD_FAILED, f"No result within {COMMAND_ACK_TIMEOUT} seconds")
+
+    # Returns the monotonic time the next command times out, or None
+    def next_deadline(self):
+        return self.deadlines[0][0] if self.deadlines else None
+
+
+# Creates the ack tracker, or returns None if acks aren't deferred
+def create_command_ack_tracker():
+    if not DEFERRED_ACKS:
+        return None
+    print(f"Acknowledging commands with the results in {COMMAND_RESULT_DIR}")
+    return CommandAckTracker(COMMAND_RESULT_DIR)
+
+
 # ============================================================================
 # IoTConnect Callback Handlers
 # ============================================================================
 
-# Handle commands received from /IOTCONNECT
-def on_command(msg: C2dCommand):
+# Builds the JSON object commands are forwarded as, with the parameters
+# space-separated, a timestamp for processing by other applications and the
+# ack_id (if any) that the consumer reports its result with
+def command_record(command_name, command_args, ack_id=None):
+    params = ""
+    for param in command_args:
+        params = params + " " + param
+    comm_dict = {
+        "command_name": command_name,
+        "parameters": params,
+        "timestamp": int(time.time())
+    }
+    if ack_id is not None:
+        comm_dict["ack_id"] = ack_id
+    return comm_dict
+
+
+# Delivers a command to its route, or to the command buffer if it has none.
+# Returns the acknowledgement message of an in-process handler, or None if
+# the command was forwarded to a consumer. Raises if the route can't take it.
+def dispatch_command(command_name, command_args, ack_id=None):
+    route = command_router.route(command_name) if command_router is not None else None
+    if route is None:
+        forward_command(command_name, command_args, ack_id)
+        return None
+    return route(command_name, command_args, ack_id)
+
+
+# Writes a command to the local command buffer for other applications
+def forward_command(command_name, command_args, ack_id=None):
+    comm_dict = command_record(command_name, command_args, ack_id)
+    print("Forwarding command --- %s %s --- to JSON buffer." % (command_name, comm_dict["parameters"]))
+    
+    # Write command to buffer with timestamp for processing by other application
+    with open(COMMAND_BUFFER_PATH, "w") as f:
+        f.write(json_dumps(comm_dict))
+    
+    # Append it to the command log, so consumers don't miss it if another
+    # command overwrites the buffer before they poll
+    if command_log is not None:
+        comm_dict["seq"] = command_log.append(comm_dict)
+    
+    # Push it to the consumers subscribed to it
+    if command_server is not None:
+        command_server.publish(comm_dict)
+
+
+# Handle commands received from /IOTCONNECT (runs on the event loop, or on the
+# command pool for file-download and in-process handlers)
+def handle_command(msg: C2dCommand):
     global c
     print("Received command", msg.command_name, msg.command_args, msg.ack_id)
     
@@ -90,7 +2466,7 @@ def on_command(msg: C2dCommand):
     if msg.command_name == "file-download":
         if len(msg.command_args) == 1:
             status_message = "Downloading %s to device" % (msg.command_args[0])
-            response = requests.get(msg.command_args[0])
+            response = requests.get(msg.command_args[0], stream=True)
             
             # Check if the request was successful (status code 200)
             if response.status_code == 200:
@@ -113,34 +2489,32 @@ def on_command(msg: C2dCommand):
             sys.stdout.flush()
             
             # Restart the process to apply updates
-            os.execv(sys.executable, [sys.executable, __file__] + [sys.argv[0]])
+            restart_application()
         else:
             c.send_command_ack(msg, C2dAck.CMD_FAILED, "Expected 1 argument")
             print("Expected 1 command argument, but got", len(msg.command_args))
     
-    # Forward all other commands to the local command buffer
+    # Forward all other commands to their route or the local command buffer
     else:
-        params = ""
-        for param in msg.command_args:
-            params = params + " " + param
-        print("Forwarding command --- %s %s --- to JSON buffer." % (msg.command_name, params))
-        
-        # Write command to buffer with timestamp for processing by other application
-        comm_dict = {
-            "command_name": msg.command_name,
-            "parameters": params,
-            "timestamp": int(time.time())
-        }
-        with open(COMMAND_BUFFER_PATH, "w") as f:
-            json.dump(comm_dict, f, indent=4)
+        try:
+            status_message = dispatch_command(msg.command_name, msg.command_args, msg.ack_id)
+        except Exception as e:
+            print(f"Unable to deliver command {msg.command_name}: {e}")
+            if msg.ack_id is not None:
+                c.send_command_ack(msg, C2dAck.CMD_FAILED, str(e))
+            return
         
-        # Send acknowledgement if required by device template
+        # Send acknowledgement if required by device template, once the
+        # consumer reports its result with deferred acks
         if msg.ack_id is not None:
-            c.send_command_ack(msg, C2dAck.CMD_SUCCESS_WITH_ACK, "Forwarding command")
+            if status_message is None and command_acks is not None:
+                command_acks.expect(msg)
+                return
+            c.send_command_ack(msg, C2dAck.CMD_SUCCESS_WITH_ACK, status_message or "Forwarding command")
 
 
-# Handle OTA updates from /IOTCONNECT
-def on_ota(msg: C2dOta):
+# Handle OTA updates from /IOTCONNECT (runs on a worker thread)
+def handle_ota(msg: C2dOta):
     global c
     print("Starting OTA downloads for version %s" % msg.version)
     c.send_ota_ack(msg, C2dAck.OTA_DOWNLOADING)
@@ -173,14 +2547,370 @@ def on_ota(msg: C2dOta):
         sys.stdout.flush()
         
         # Restart the process to apply updates
-        os.execv(sys.executable, [sys.executable, __file__] + [sys.argv[0]])
+        restart_application()
     else:
         print('Encountered a download processing error. Not restarting.')
 
 
+# The SDK calls these from its MQTT thread. They only hand the message over
+# to the event loop and return, so a slow command or OTA download never
+# blocks the SDK.
+def on_command(msg: C2dCommand):
+    hand_off(command_queue, msg)
+
+
+def on_ota(msg: C2dOta):
+    hand_off(ota_queue, msg)
+
+
 # Handle disconnection events from /IOTCONNECT
 def on_disconnect(reason: str, disconnected_from_server: bool):
     print("Disconnected%s. Reason: %s" % (" from server" if disconnected_from_server else "", reason))
+    # Wake the publisher so it reconnects right away. The SDK may also call
+    # this for the disconnect on exit, after the event loop has been closed.
+    if event_loop is not None and not event_loop.is_closed():
+        try:
+            event_loop.call_soon_threadsafe(outbox_ready.set)
+        except RuntimeError:
+            pass  # Closed meanwhile
+
+
+# ============================================================================
+# Agent Tasks
+# ============================================================================
+
+# Set up by main() once the event loop is running
+event_loop = None
+command_queue = None
+command_pool = None  # Threads running commands that may block
+command_workers = None  # Semaphore bounding the commands on command_pool
+command_slots = {}  # Command name -> semaphore enforcing its COMMAND_CONCURRENCY
+ota_queue = None
+outbox_ready = None  # Set when records were added to the outbox
+outbox = []  # Records read and filtered by the ingest task, waiting for the publish task
+background_tasks = set()
+
+
+# Passes an item from an SDK callback thread to an event loop queue
+def hand_off(queue, item):
+    event_loop.call_soon_threadsafe(queue.put_nowait, item)
+
+
+# Adds a record to the outbox for the publish task
+def add_to_outbox(timestamp, values):
+    outbox.append((timestamp, values))
+    outbox_ready.set()
+
+
+# Runs a blocking function on a worker thread (of executor, if given),
+# printing any error it raises
+async def run_blocking(function, *args, executor=None):
+    try:
+        await event_loop.run_in_executor(executor, function, *args)
+    except Exception as e:
+        print(f"Error in {function.__name__}: {e}")
+
+
+# Starts a coroutine as an independent task, keeping a reference until it finishes
+def start_background_task(coroutine):
+    task = asyncio.ensure_future(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+# Returns the latest data buffer (or spool directory) content as the
+# attributes it is sent as, for the heartbeat and full delta snapshots.
+# Aggregated, sketched and waveform attributes are left out as they are only
+# sent as their summaries. Returns None if the only data sources are event
+# streams (a "jsonl" buffer, the data socket or rings), whose records mustn't
+# be re-sent as new samples.
+def current_snapshot():
+    values = reader.snapshot()
+    if not values:
+        return None
+    if transform_plan is not None:
+        values = transform_plan.apply(values)
+    if template_validator is not None:
+        values = template_validator.apply(values)
+    summarized = set()
+    if waveform_processor is not None:
+        summarized.update(WAVEFORM_ATTRIBUTES)
+    if aggregator is not None:
+        summarized.update(AGGREGATE_ATTRIBUTES)
+    if sketch_aggregator is not None:
+        summarized.update(SKETCH_ATTRIBUTES)
+    values = {key: value for key, value in values.items() if key not in summarized}
+    return values or None
+
+
+# Reads every data source whenever a producer writes or the next tick is due,
+# and hands the validated and filtered records to the publish task
+async def ingest_telemetry():
+    data_ready = asyncio.Event()
+    if watcher is not None:
+        event_loop.add_reader(watcher.fileno(), handle_watcher_readable, watcher, data_ready)
+    if ingest_server is not None:
+        ingest_server.attach(event_loop, data_ready.set)
+    scheduler = TickScheduler(DATA_FREQUENCY)
+
+    while True:
+        # Forget notifications for data that is about to be read anyway
+        data_ready.clear()
+
+        # Read telemetry data from buffer, skipping unchanged data. Waiting out
+        # a producer's lock blocks, so this runs on a worker thread.
+        records = await event_loop.run_in_executor(None, reader.read_records)
+        if ingest_server is not None:
+            records += ingest_server.take_records()
+        if ring_reader is not None:
+            records += ring_reader.drain()
+
+        # Turn raw producer values into template attributes
+        if transform_plan is not None:
+            records = apply_stage(records, transform_plan.apply)
+
+        # Hand waveforms to the worker processes, whose features arrive later
+        if waveform_processor is not None:
+            records = waveform_processor.submit(records)
+
+        # Drop attributes the template doesn't know
+        if template_validator is not None:
+            records = apply_stage(records, template_validator.apply)
+
+        # Send alerts the moment a rule fires or clears instead of on the next
+        # tick, and run the rule's local command
+        if rule_engine is not None:
+            for rule, active, timestamp, value in rule_engine.evaluate(records) + rule_engine.check_pending(time.time()):
+                print(f"Alert {rule.name} {'fired' if active else 'cleared'} at {rule.attribute}={value}")
+                publish([(timestamp, {rule.name: active, rule.attribute: value})])
+                stats["alerts_sent"] += 1
+                if active and rule.command:
+                    try:
+                        dispatch_command(rule.command[0], rule.command[1:])
+                    except Exception as e:
+                        print(f"Unable to deliver command {rule.command[0]} of alert {rule.name}: {e}")
+
+        # Collect aggregated and sketched attributes, sending their statistics
+        # and percentiles once per tick
+        tick = scheduler.due()
+        summary = {}
+        if aggregator is not None:
+            records = apply_stage(records, aggregator.add)
+            if tick:
+                summary.update(aggregator.summarize())
+        if sketch_aggregator is not None:
+            records = apply_stage(records, sketch_aggregator.add)
+            if tick:
+                summary.update(sketch_aggregator.summarize())
+        if summary:
+            records.append((datetime.now(timezone.utc), summary))
+
+        # Only report attributes that moved past their deadband, and with delta
+        # payloads only those that changed since they were last sent
+        if deadband_filter is not None:
+            records = apply_stage(records, deadband_filter.apply)
+            silent = deadband_filter.check_silence()
+            if silent:
+                records.append((datetime.now(timezone.utc), silent))
+        if delta_encoder is not None:
+            snapshot = current_snapshot() if delta_encoder.snapshot_due() else None
+            records = apply_stage(records, lambda values: delta_encoder.encode(values, snapshot))
+
+        if records:
+            outbox.extend(records)
+            outbox_ready.set()
+        reader.commit()
+
+        report_stats()
+
+        # Wait for the next tick, waking early if the buffer is rewritten,
+        # records arrive on the data socket, an alert rule's duration is up or
+        # a deadbanded attribute has been silent too long
+        if tick:
+            scheduler.advance()
+        now = time.monotonic()
+        deadline = max(now, scheduler.next_tick)
+        due_time = rule_engine.next_due_time() if rule_engine is not None else None
+        if due_time is not None:
+            deadline = min(deadline, max(now, now + due_time - time.time()))
+        silence_time = deadband_filter.next_due_time() if deadband_filter is not None else None
+        if silence_time is not None:
+            deadline = min(deadline, max(now, silence_time))
+        await wait_for_data(data_ready, now + MIN_SEND_INTERVAL, deadline)
+
+
+# Keeps the connection up and sends the records from the outbox, one message
+# per record or in batches, queueing them instead while disconnected. Returns
+# the exit code if the connection can't be established.
+async def publish_telemetry():
+    last_send_time = 0
+    next_connect_time = 0
+
+    while True:
+        outbox_ready.clear()
+
+        # Ensure connection is established, without stalling the other tasks
+        if not c.is_connected() and time.monotonic() >= next_connect_time:
+            print('(re)connecting...')
+            await event_loop.run_in_executor(None, c.connect)
+            if not c.is_connected():
+                if offline_queue is None:
+                    # Still unable to connect after retries
+                    print('Unable to connect. Exiting.')
+                    return 2
+                print(f'Unable to connect. Queueing telemetry and retrying in {RECONNECT_INTERVAL} seconds.')
+                next_connect_time = time.monotonic() + RECONNECT_INTERVAL
+
+        records = outbox[:]
+        outbox.clear()
+
+        # Re-send the latest data buffer if nothing was sent for too long
+        pending = batcher is not None and batcher.records
+        if (not records and not pending and last_send_time and c.is_connected()
+                and HEARTBEAT_INTERVAL and time.monotonic() - last_send_time >= HEARTBEAT_INTERVAL):
+            snapshot = current_snapshot()
+            if snapshot:
+                records.append((datetime.now(timezone.utc), snapshot))
+            else:
+                last_send_time = time.monotonic()  # Nothing to re-send, so check again after another interval
+
+        # Transmit to IoTConnect
+        if batcher is None:
+            batches = [[record] for record in records]
+        else:
+            batcher.add(records)
+            batches = batcher.take_due_batches()
+        for batch in batches:
+            if publish(batch):
+                last_send_time = time.monotonic()
+        if offline_queue is not None and offline_queue.count and c.is_connected():
+            offline_queue.drain()
+        if batcher is not None:
+            batcher.check_acknowledgements()
+
+        # Wait for new records, or until a batch, heartbeat, queue drain,
+        # broker ack or connection check is due
+        now = time.monotonic()
+        deadline = now + DATA_FREQUENCY
+        if batcher is not None and batcher.records:
+            deadline = min(deadline, batcher.flush_deadline())
+        if batcher is not None and batcher.unacknowledged:
+            deadline = min(deadline, now + 0.05)  # Poll for the broker's acks
+        if last_send_time and HEARTBEAT_INTERVAL:
+            deadline = min(deadline, last_send_time + HEARTBEAT_INTERVAL)
+        if offline_queue is not None and offline_queue.count and c.is_connected():
+            deadline = min(deadline, now + 1)  # Keep draining the queue
+        if not c.is_connected():
+            deadline = min(deadline, next_connect_time)
+        try:
+            await asyncio.wait_for(outbox_ready.wait(), max(0, deadline - now))
+        except asyncio.TimeoutError:
+            pass
+
+
+# Takes cloud commands in arrival order and starts each as its own task, so
+# a slow command holds up neither the others, command acks nor telemetry.
+# command_queue_depth counts the commands waiting for a slot or a worker.
+async def forward_commands():
+    if command_server is not None:
+        command_server.attach(event_loop, command_acks.resolve if command_acks is not None else None)
+    while True:
+        msg = await command_queue.get()
+        stats["command_queue_depth"] += 1
+        stats["command_queue_depth_max"] = max(stats["command_queue_depth_max"], stats["command_queue_depth"])
+        start_background_task(run_command(msg))
+
+
+# Returns the semaphore limiting how many commands of a name run at once, or
+# None if they are unlimited
+def command_slot(command_name):
+    slot = command_slots.get(command_name)
+    if slot is None:
+        limit = COMMAND_CONCURRENCY.get(command_name, COMMAND_CONCURRENCY.get("*"))
+        if limit is None:
+            return None
+        slot = command_slots[command_name] = asyncio.Semaphore(limit)
+    return slot
+
+
+# Handles a command once its name has a free slot. Downloads and in-process
+# handlers may block, so they wait for one of the COMMAND_WORKERS threads;
+# anything else only writes local files and sockets and runs on the event
+# loop. Commands that don't wait start in arrival order.
+async def run_command(msg):
+    blocking = msg.command_name == "file-download" or (command_router is not None and command_router.runs_handler(msg.command_name))
+    slots = [slot for slot in (command_slot(msg.command_name), command_workers if blocking else None) if slot is not None]
+    for slot in slots:
+        await slot.acquire()
+    stats["command_queue_depth"] -= 1
+    try:
+        if blocking:
+            await run_blocking(handle_command, msg, executor=command_pool)
+        else:
+            handle_command(msg)
+    except Exception as e:
+        print(f"Error in handle_command: {e}")
+    finally:
+        for slot in slots:
+            slot.release()
+
+
+# Sends the deferred acks as consumers report results, and fails the commands
+# whose results are overdue. Result files are picked up as soon as they are
+# written with inotify, else within a second.
+async def track_command_acks():
+    results_ready = asyncio.Event()
+    try:
+        watcher = DirectoryWatcher(COMMAND_RESULT_DIR)
+    except (OSError, AttributeError):
+        watcher = None
+    else:
+        def handle_readable():
+            if watcher.read_changes():
+                results_ready.set()
+        event_loop.add_reader(watcher.fileno(), handle_readable)
+
+    while True:
+        results_ready.clear()
+        command_acks.read_result_files()
+        command_acks.expire()
+
+        # A command expected meanwhile can't time out before this
+        now = time.monotonic()
+        deadline = command_acks.next_deadline() or now + COMMAND_ACK_TIMEOUT
+        if watcher is None:
+            deadline = min(deadline, now + 1)
+        try:
+            await asyncio.wait_for(results_ready.wait(), max(0, deadline - now))
+        except asyncio.TimeoutError:
+            pass
+
+
+# Processes OTA updates one at a time on a worker thread
+async def process_ota_updates():
+    while True:
+        msg = await ota_queue.get()
+        await run_blocking(handle_ota, msg)
+
+
+# Runs the ingest, publish, command, OTA and (with deferred acks) ack tasks on
+# one event loop until one of them stops, and returns its exit code
+async def main():
+    global event_loop, command_queue, ota_queue, outbox_ready, command_pool, command_workers
+    event_loop = asyncio.get_running_loop()
+    command_queue = asyncio.Queue()
+    command_pool = concurrent.futures.ThreadPoolExecutor(COMMAND_WORKERS, thread_name_prefix="command")
+    command_workers = asyncio.Semaphore(COMMAND_WORKERS)
+    ota_queue = asyncio.Queue()
+    outbox_ready = asyncio.Event()
+    coroutines = [ingest_telemetry(), publish_telemetry(), forward_commands(), process_ota_updates()]
+    if command_acks is not None:
+        coroutines.append(track_command_acks())
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    for task in tasks:
+        task.cancel()
+    return done.pop().result()
 
 
 # ============================================================================
@@ -188,6 +2918,9 @@ def on_disconnect(reason: str, disconnected_from_server: bool):
 # ============================================================================
 
 try:
+    # Start the waveform worker processes before anything else starts threads
+    waveform_processor = create_waveform_processor(add_to_outbox)
+
     # Load device configuration from files
     device_config = DeviceConfig.from_iotc_device_config_json_file(
         device_config_json_path="iotcDeviceConfig.json",
@@ -205,36 +2938,54 @@ try:
         )
     )
     
-    # Main telemetry loop
-    while True:
-        # Ensure connection is established
-        if not c.is_connected():
-            print('(re)connecting...')
-            c.connect()
-            if not c.is_connected():
-                # Still unable to connect after retries
-                print('Unable to connect. Exiting.')
-                cleanup_command_buffer()
-                sys.exit(2)
-
-        # Read telemetry data from buffer and transmit to IoTConnect
-        with open(DATA_BUFFER_PATH, "r") as f:
-            telemetry = json.load(f)
-        c.send_telemetry(telemetry)
-        
-        # Wait before next transmission
-        time.sleep(DATA_FREQUENCY)
+    print(f"Using {json_backend} for JSON")
+
+    # Set up the telemetry pipeline
+    reader = create_data_reader()
+    watcher = create_data_buffer_watcher()
+    ingest_server = create_ingest_server()
+    ring_reader = create_ring_reader()
+    transform_plan = create_transform_plan()
+    template_validator = create_template_validator()
+    rule_engine = create_rule_engine()
+    aggregator = create_aggregator()
+    sketch_aggregator = create_sketch_aggregator()
+    deadband_filter = create_deadband_filter()
+    delta_encoder = create_delta_encoder()
+    batcher = create_batcher()
+    offline_queue = create_offline_queue()
+    command_log = create_command_log()
+    command_server = create_command_server()
+    command_router = create_command_router()
+    command_acks = create_command_ack_tracker()
+
+    # Run the telemetry, command and OTA tasks until interrupted, or until the
+    # connection can't be established
+    exit_code = asyncio.run(main())
+    if waveform_processor is not None:
+        waveform_processor.close()
+    cleanup_command_buffer()
+    cleanup_sockets()
+    sys.exit(exit_code)
 
 except DeviceConfigError as dce:
     # Handle device configuration errors (invalid config files, missing certs, etc.)
     print(dce)
+    if waveform_processor is not None:
+        waveform_processor.close()
     cleanup_command_buffer()
+    cleanup_sockets()
     sys.exit(1)
 
 except KeyboardInterrupt:
     # Handle graceful shutdown on Ctrl+C
     print("Exiting.")
+    # Don't drop records still waiting to be sent
+    flush_pending()
     if c.is_connected():
         c.disconnect()
+    if waveform_processor is not None:
+        waveform_processor.close()
     cleanup_command_buffer()
+    cleanup_sockets()
     sys.exit(0)